@@ -3,7 +3,10 @@ TELEPYTHIC -- a python interface to test equipment
 Copyright 2014-2020 by Martijn Jasperse
 https://github.com/mjasperse/telepythic
 """
-from .telepythic import TelepythicDevice, find_visa, pyvisa_connect
+from .telepythic import TelepythicDevice, find_visa, pyvisa_connect, parallel
 from .telepythic import TelepythicError, ConnectionError, QueryError
 from .tcp import TCPInterface, TelnetInterface
-from .prologix import PrologixInterface
+from .udp import UDPInterface
+from .prologix import PrologixInterface, PrologixBus
+from .pool import ConnectionPool, pooled
+from .replay import RecordingInterface, ReplayInterface
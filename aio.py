@@ -0,0 +1,418 @@
+"""
+TELEPYTHIC -- a python interface to test equipment
+Copyright 2014-2020 by Martijn Jasperse
+https://github.com/mjasperse/telepythic
+
+Asynchronous counterparts of the interface and device classes, built on asyncio streams.
+This allows a single event loop to communicate with many devices concurrently, e.g.
+
+    async def main():
+        ifc = await AsyncTCPInterface('192.168.1.10',5025).connect()
+        dev = AsyncTelepythicDevice(ifc)
+        print(await dev.id())
+"""
+import asyncio, socket
+import numpy as np
+from .telepythic import TelepythicDevice, TelepythicError, ConnectionError, QueryError
+from .telepythic import _as_query, _block_dest, _block_result, _block_array, _block_file, _block_store
+from .tcp import TelnetInterface, _resolve_host
+from .prologix import _setup_commands
+
+class AsyncTCPInterface:
+    _protocol = 'TCP'
+    def __init__(self, host, port, timeout=1, eom=b'\r\n', trim=True, buffer=65536, term=None, maxsize=None):
+        """
+        Describe an asynchronous connection to the specified TCP device. The connection is opened by awaiting connect().
+    
+        Keyword arguments are per TCPInterface
+        """
+        self.host = _resolve_host(host)
+        self.port = port
+        self.timeout = timeout
+        self.eom = eom
+        self.trim = trim
+        self.buffer = buffer
+        if term is None and eom:
+            term = eom[-1:]
+        self.term = term
+        self.maxsize = maxsize
+        # received data which has not yet been consumed
+        self.rbuf = bytearray()
+        self.reader = self.writer = None
+        self.stats = None
+    
+    def __str__(self):
+        return '%s device at %s:%i'%(self._protocol,self.host,self.port)
+    
+    async def connect(self):
+        """Open the connection to the device, and return this instance"""
+        try:
+            self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(self.host,self.port), self.timeout)
+        except asyncio.TimeoutError:
+            raise ConnectionError(self,None,'Connection timed out')
+        return self
+    
+    async def close(self):
+        """Close the associated connection"""
+        self.writer.close()
+        await self.writer.wait_closed()
+        self.reader = self.writer = None
+    
+    async def flush(self,timeout=0.01):
+        """Removes any pending data to be received, and returns the number of bytes flushed"""
+        # discard anything already buffered
+        n = len(self.rbuf)
+        del self.rbuf[:]
+        # read until nothing arrives within the timeout
+        while 1:
+            try:
+                data = await asyncio.wait_for(self.reader.read(self.buffer), timeout)
+            except asyncio.TimeoutError:
+                break
+            if not data:
+                break
+            n += len(data)
+        return n
+    
+    async def read(self):
+        """Read a response up to and including the terminator, per TCPInterface.read()"""
+        if self.term is None:
+            # no framing, return whatever is available
+            data = await self._read_available()
+        else:
+            end = await self._find_term()
+            data = bytes(self.rbuf[:end])
+            del self.rbuf[:end]
+        if self.trim:
+            return data.strip()
+        return data
+    
+    async def _recv(self):
+        """Receive a single chunk into the read buffer, and return the number of bytes received"""
+        data = await asyncio.wait_for(self.reader.read(self.buffer), self.timeout)
+        if not data:
+            raise socket.error('Connection closed by remote host')
+        if self.stats is not None:
+            self.stats.received(len(data))
+        self.rbuf += data
+        return len(data)
+    
+    async def _read_available(self):
+        """Return everything buffered, or if there is nothing buffered the data from a single receive"""
+        if not len(self.rbuf):
+            await self._recv()
+        data = bytes(self.rbuf)
+        del self.rbuf[:]
+        return data
+    
+    async def _find_term(self):
+        """Receive until the terminator is in the read buffer, and return the index just past it"""
+        term = self.term
+        start = 0
+        while 1:
+            # only search the data that has not already been searched
+            i = self.rbuf.find(term, start)
+            if i >= 0:
+                return i + len(term)
+            if self.maxsize is not None and len(self.rbuf) > self.maxsize:
+                del self.rbuf[:]
+                raise IOError('Response exceeds maximum size of %i bytes'%self.maxsize)
+            start = max(0, len(self.rbuf) - len(term) + 1)
+            try:
+                await self._recv()
+            except asyncio.TimeoutError:
+                if not len(self.rbuf):
+                    raise
+                # unterminated response, return what we have
+                return len(self.rbuf)
+    
+    async def read_end(self):
+        """Consume the terminator following raw data (e.g. a binary block), per TCPInterface.read_end()"""
+        if self.term is None:
+            return b''
+        n = 0
+        try:
+            while 1:
+                if len(self.rbuf) <= n:
+                    await self._recv()
+                if self.rbuf[n:n+len(self.term)] == self.term:
+                    n += len(self.term)
+                    break
+                if self.rbuf[n:n+1] not in (b'\r',b'\n'):
+                    n = 0
+                    break
+                n += 1
+        except asyncio.TimeoutError:
+            n = 0
+        data = bytes(self.rbuf[:n])
+        del self.rbuf[:n]
+        return data
+    
+    async def read_raw(self,size):
+        """Reads exactly "size" bytes"""
+        data = bytearray(size)
+        await self.read_into(data)
+        return bytes(data)
+    
+    async def read_into(self,buf):
+        """Fills the writable buffer "buf" with exactly len(buf) bytes. Returns the number of bytes read"""
+        view = memoryview(buf).cast('B')
+        size = len(view)
+        # consume buffered data first
+        n = min(size, len(self.rbuf))
+        if n:
+            view[:n] = self.rbuf[:n]
+            del self.rbuf[:n]
+        while n < size:
+            data = await asyncio.wait_for(self.reader.read(min(self.buffer, size-n)), self.timeout)
+            if not data:
+                raise socket.error('Connection closed by remote host')
+            if self.stats is not None:
+                self.stats.received(len(data))
+            view[n:n+len(data)] = data
+            n += len(data)
+        return n
+    
+    async def write(self,msg):
+        """Sends the "msg" string, appending the End-Of-Message (eom) string if not present. Returns the number of bytes sent"""
+        # append eom if not already there
+        if self.eom is not None and not msg.endswith(self.eom):
+            msg += self.eom
+        self.writer.write(msg)
+        await self.writer.drain()
+        if self.stats is not None:
+            self.stats.sent(len(msg))
+        # return bytes sent
+        return len(msg)
+
+
+class AsyncTelnetInterface(AsyncTCPInterface):
+    _protocol = 'Telnet'
+    def __init__(self, host, port=23, timeout=1, eom=b'\n', prompt=b'> ', initial=None):
+        """
+        Describe an asynchronous Telnet-style connection, see TelnetInterface. The connection is opened by awaiting connect().
+    
+        Keyword arguments are per TelnetInterface
+        """
+        AsyncTCPInterface.__init__(self,host,port,timeout=timeout,eom=eom,trim=False)
+        TelnetInterface._compile_prompt(self,prompt)
+        self.initial = initial
+    
+    async def connect(self):
+        """Open the connection and wait for the ready prompt, returning this instance"""
+        await AsyncTCPInterface.connect(self)
+        if self.initial is not None:
+            await self.write(self.initial)
+        try:
+            # wait for the ready prompt
+            while self.re_end.search(self.rbuf, max(0, len(self.rbuf) - self.overlap)) is None:
+                await self._recv()
+            del self.rbuf[:]
+        except asyncio.TimeoutError as e:
+            raise ConnectionError(self,e,'Connected but no ready prompt, check Telnet is enabled')
+        return self
+    
+    async def read(self):
+        """Read data until the ready-for-input prompt is received, per TelnetInterface.read()"""
+        data = bytearray()
+        scanned = 0     # length of data already searched for a prompt
+        while 1:
+            data += await self._read_available()
+            if TelnetInterface._end_of_reply(self, data, scanned):
+                break
+            scanned = len(data)
+        return bytes(data).rstrip()
+    
+    async def flush(self,timeout=0.25):
+        """Flush any data waiting to be read (default timeout 250ms)"""
+        return await AsyncTCPInterface.flush(self,timeout)
+
+
+class AsyncPrologixInterface(AsyncTCPInterface):
+    _protocol = 'Prologix'
+    def __init__(self, gpib, host, port=1234, timeout=1, auto=True, assert_eoi=True, eos=None, poll=True):
+        """
+        Describe an asynchronous connection to a device through a Prologix Ethernet<->GPIB bridge, see PrologixInterface.
+        The connection is opened and the bridge configured by awaiting connect().
+    
+        Keyword arguments are per PrologixInterface
+        """
+        # prologix itself requires '\n' eom termination
+        AsyncTCPInterface.__init__(self,host,port,timeout,eom=b'\n')
+        self.setup = _setup_commands(gpib,timeout,auto,assert_eoi,eos)
+        self.auto = auto
+        self.initial_poll = poll
+    
+    async def connect(self):
+        """Open the connection and configure the bridge, returning this instance"""
+        await AsyncTCPInterface.connect(self)
+        # identify and configure the bridge in a single message
+        await self.write(b''.join([b'++ver\n'] + self.setup))
+        # make sure it's what we expect
+        if not (await self.read(True)).startswith(b'Prologix GPIB'):
+            raise ConnectionError(self,None,'Not a Prologix device')
+        # can we serial poll the device?
+        if self.initial_poll:
+            try:    await self.poll()
+            except: raise ConnectionError(self,None,'Device did not respond to poll')
+        return self
+    
+    async def read(self,immediate=False):
+        """Read data from the Prologix unit, per PrologixInterface.read()"""
+        # if we're not in auto mode, need to tell prologix to read
+        if not immediate and not self.auto: await self.write(b'++read eoi\n')
+        return await AsyncTCPInterface.read(self)
+    
+    async def clear(self):              await self.write(b'++clr\n')
+    async def lock(self,locked=True):   await self.write(b'++llo\n' if locked else b'++loc\n')
+    async def local(self):              await self.write(b'++loc\n')
+    async def reset(self):              await self.write(b'++rst\n')
+    async def poll(self):               await self.write(b'++spoll\n'); return int(await self.read(True))
+    async def srq(self):                await self.write(b'++seq\n'); return int(await self.read(True))
+
+
+def _interface_mutex(interface):
+    """Return the asyncio lock which serialises transactions on "interface", creating it if the interface doesn't have one"""
+    mutex = getattr(interface,'mutex',None)
+    if mutex is None:
+        mutex = asyncio.Lock()
+        try:    interface.mutex = mutex
+        except: pass
+    return mutex
+
+
+class AsyncTelepythicDevice:
+    def __init__(self,interface):
+        """
+        Create a device instance using the provided asynchronous interface, with the same functions as TelepythicDevice as coroutines.
+    
+        The interface can be any class that provides the following coroutines:
+            read(), read_raw(), write()
+        """
+        self.dev = interface
+        # lock that makes each transaction atomic, shared by all devices using the same interface
+        self.mutex = _interface_mutex(interface)
+        # reply types by command mnemonic, see TelepythicDevice.parse_reply()
+        self.schemas = {}
+        self.inferred = {}
+    
+    # reply parsing does not involve any communication
+    parse_reply = TelepythicDevice.parse_reply
+    
+    async def id(self,expect=None,match_case=True):
+        """Return the response to the *IDN? query, see TelepythicDevice.id()"""
+        id = await self.ask(b'*IDN?')
+        if expect is not None:
+            if hasattr(expect,'encode'):    # we SHOULDN'T be passed unicode, but we might be
+                expect = expect.encode()
+            if not match_case:
+                id = id.upper()
+                expect = expect.upper()
+            if not id.startswith(expect):
+                raise TelepythicError(self.dev,None,'Expected ID '+repr(expect)+', got '+repr(id))
+        return id
+    
+    async def read_block(self,format=None,out=None):
+        """Read a GPIB-style block of binary data from the device, see TelepythicDevice.read_block()"""
+        if format is None and out is not None:
+            format = getattr(out,'dtype','u1')
+        head = await self.read_raw(2)
+        assert head[:1] == b'#', 'Not a binary block array'
+        hlen = int(head[1:2])
+        assert hlen > 0, 'Indefinite blocks not supported'
+        dlen = await self.read_raw(hlen)
+        assert len(dlen) == hlen, 'Comms fail during read_block'
+        dlen = int(dlen)
+        result = await self._read_payload(dlen,format,out)
+        await self.dev.read_end()
+        return result
+    
+    async def _read_payload(self,dlen,format,out):
+        """Read the "dlen" bytes of block data following the header"""
+        if format is None:
+            return await self.read_raw(dlen)
+        out = _block_file(out,dlen,format)
+        if out is not None and not isinstance(out,np.ndarray):
+            return _block_store([_block_array(await self.read_raw(dlen),format)],out,dlen,format)
+        # receive straight into the destination array
+        arr = _block_dest(dlen,format,out)
+        await self.read_into(arr.view(np.uint8))
+        return _block_result(arr,out)
+    
+    async def ask(self, query, size=None):
+        """Write the command "query" and read the reply, see TelepythicDevice.ask()"""
+        try:
+            async with self.mutex:
+                await self.dev.write(query)
+                if size is None:
+                    return await self.dev.read()
+                else:
+                    return await self.dev.read_raw(size)
+        except Exception as e:
+            raise QueryError(self.dev, e, query)
+    
+    async def ask_block(self, query, format=None, out=None):
+        """Ask a query that returns a GPIB "block" format response. See also read_block()"""
+        try:
+            async with self.mutex:
+                await self.dev.write(query)
+                return await self.read_block(format,out)
+        except Exception as e:
+            raise QueryError(self.dev, e, query)
+    
+    async def query(self, query):
+        """Ask "query" and return the parsed response, see TelepythicDevice.query()"""
+        if hasattr(query,'encode'):   # we SHOULDN'T be passed a unicode string, but we might be
+            query = query.encode()
+        if isinstance(query,bytes):
+            query = _as_query(query)
+            return self.parse_reply(await self.ask(query), query)
+        else:
+            return { q: await self.query(q) for q in query }
+    
+    async def read(self):
+        """Read data from the device (until EOM)"""
+        try:
+            return await self.dev.read()
+        except Exception as e:
+            raise TelepythicError(self.dev, e)
+    
+    async def read_raw(self, size):
+        """Read exactly "size" bytes from the device"""
+        try:
+            return await self.dev.read_raw(size)
+        except Exception as e:
+            raise TelepythicError(self.dev, e)
+    
+    async def read_into(self, buf):
+        """Fill the writable buffer "buf" with exactly len(buf) bytes from the device, returning the number of bytes read"""
+        try:
+            return await self.dev.read_into(buf)
+        except Exception as e:
+            raise TelepythicError(self.dev, e)
+    
+    async def write(self, msg):
+        """Write the specified string to the device"""
+        try:
+            return await self.dev.write(msg)
+        except Exception as e:
+            raise TelepythicError(self.dev, e)
+    
+    async def flush(self):
+        """Removes any pending response, returning the number of bytes flushed, or -1 if not supported by the device"""
+        if hasattr(self.dev,"flush"):
+            try:
+                return await self.dev.flush()
+            except Exception as e:
+                raise TelepythicError(self.dev, e)
+        return -1
+    
+    async def close(self):
+        """Close the connection to the associated device. Unlocks the device if the relevant command exists."""
+        if hasattr(self,"lock"):
+            await self.lock(False)
+        elif hasattr(self.dev,"lock"):
+            await self.dev.lock(False)
+        if hasattr(self.dev,"close"):
+            await self.dev.close()
+        self.dev = None
@@ -0,0 +1,99 @@
+"""
+TELEPYTHIC -- a python interface to test equipment
+Copyright 2014-2020 by Martijn Jasperse
+https://github.com/mjasperse/telepythic
+
+Throughput and latency benchmarks of the interfaces, against the in-process simulators in sim.py.
+
+Usage: python -m telepythic.benchmark [-h] [options]
+"""
+from timeit import default_timer as clock
+from .telepythic import TelepythicDevice
+from .tcp import TCPInterface, TelnetInterface
+from .prologix import PrologixInterface
+from . import sim
+
+def connect(kind, buffer, fragment=None, delay=0):
+    """Start a simulator of the specified kind ('tcp', 'telnet' or 'prologix') and return a tuple (simulator, device)"""
+    if kind == 'tcp':
+        server = sim.SCPISimulator(fragment=fragment, delay=delay)
+        ifc = TCPInterface(server.host, server.port, eom=b'\n', buffer=buffer)
+    elif kind == 'telnet':
+        server = sim.TelnetSimulator(fragment=fragment, delay=delay)
+        ifc = TelnetInterface(server.host, server.port, eom=b'\r\n')
+        ifc.buffer = buffer
+    elif kind == 'prologix':
+        server = sim.PrologixSimulator(fragment=fragment, delay=delay)
+        ifc = PrologixInterface(1, server.host, server.port)
+        ifc.buffer = buffer
+    else:
+        raise ValueError('Unknown interface '+repr(kind))
+    return server, TelepythicDevice(ifc)
+
+def bench_latency(dev, repeat=200):
+    """Return the mean round-trip time (in seconds) of a short query"""
+    start = clock()
+    for i in range(repeat):
+        dev.ask(b'*IDN?')
+    return (clock() - start)/repeat
+
+def bench_block(dev, size, repeat=5, format='u1'):
+    """Return the throughput (in MB/s) of reading a binary block of "size" bytes with read_block()"""
+    start = clock()
+    for i in range(repeat):
+        dev.ask_block(b'BLOCK? %i'%size, format)
+    return size*repeat/(clock() - start)/1e6
+
+def bench_ascii(dev, count, repeat=5):
+    """Return the throughput (in MB/s) of reading a comma-separated response of "count" values with read()"""
+    nbytes = 0
+    start = clock()
+    for i in range(repeat):
+        nbytes += len(dev.ask(b'ASCII? %i'%count))
+    return nbytes/(clock() - start)/1e6
+
+def run(kinds=('tcp','telnet','prologix'), sizes=(1<<10,1<<16,1<<20,1<<24), buffers=(1024,65536), fragment=None, delay=0, repeat=5, out=None):
+    """Run the benchmarks for each combination of interface, block size and buffer size, printing a table to "out" (default stdout) and returning a list of result dicts (throughput in MB/s, latency in ms)"""
+    import sys
+    out = out or sys.stdout
+    results = []
+    out.write('%-9s %8s %10s %12s %12s %12s\n'%('interface','buffer','size','block MB/s','ascii MB/s','latency ms'))
+    for kind in kinds:
+        for buffer in buffers:
+            server, dev = connect(kind, buffer, fragment, delay)
+            try:
+                latency = bench_latency(dev)
+                for size in sizes:
+                    r = {
+                        'interface': kind,
+                        'buffer': buffer,
+                        'size': size,
+                        'block': bench_block(dev, size, repeat),
+                        'ascii': bench_ascii(dev, max(1,size//4), repeat),
+                        'latency': latency*1e3,
+                    }
+                    results.append(r)
+                    out.write('%(interface)-9s %(buffer)8i %(size)10i %(block)12.1f %(ascii)12.1f %(latency)12.3f\n'%r)
+                    out.flush()
+            finally:
+                dev.close()
+                server.close()
+    return results
+
+
+if __name__ == '__main__':
+    import argparse
+    opt = argparse.ArgumentParser(description = "Benchmark the telepythic interfaces against simulated devices")
+    opt.add_argument('-i','--interface',choices=['tcp','telnet','prologix'],action='append',help='interface(s) to benchmark (default: all)')
+    opt.add_argument('-s','--size',type=int,action='append',help='block size(s) in bytes')
+    opt.add_argument('-b','--buffer',type=int,action='append',help='receive buffer size(s) in bytes')
+    opt.add_argument('-f','--fragment',type=int,help='split responses into packets of this many bytes')
+    opt.add_argument('-d','--delay',type=float,default=0,help='delay between packets, in seconds')
+    opt.add_argument('-n','--repeat',type=int,default=5,help='number of repetitions')
+    args = opt.parse_args()
+    run(kinds = args.interface or ('tcp','telnet','prologix'),
+        sizes = args.size or (1<<10,1<<16,1<<20,1<<24),
+        buffers = args.buffer or (1024,65536),
+        fragment = args.fragment,
+        delay = args.delay,
+        repeat = args.repeat)
@@ -27,8 +27,15 @@ def process_args(name,tcp_only=False,output=True,port=None):
 	return args
 
 def parse(name,telnet=False,*args,**kwargs):
+	return parse_output(name,telnet,*args,**kwargs)[0]
+
+def parse_output(name,telnet=False,*args,**kwargs):
+	"""As per parse(), but returns a tuple (interface, filename) including the file specified with -o/--output (or None)"""
 	args = process_args(name,*args,**kwargs)
 	f = args.pop('output',None)
+	return connect(args,telnet), f
+
+def connect(args,telnet=False):
 	if 'visa' in args:
 		# VISA connection
 		return telepythic.find_visa(args['visa'],args['timeout'])
@@ -11,34 +11,76 @@ Programming guide: http://cp.literature.agilent.com/litweb/pdf/86140-90069.pdf
 from telepythic import TelepythicDevice, PrologixInterface
 import numpy as np
 
+TRACES = [b'TRA', b'TRB', b'TRC', b'TRD', b'TRE', b'TRF']
+
 class Agilent86140b(TelepythicDevice):
 	"""Helper class for interfacing with Agilent 86140B optical spectrum analyser"""
 	def __init__(self, interface):
 		TelepythicDevice.__init__(self,interface)
 		# confirm device identity
 		self.id(b'AGILENT,86140B')
+		# data format last set with FORM, or None if unknown
+		self.format = None
+		
+	def write(self, msg):
+		"""Write the specified string to the device, noting if the data format may have changed"""
+		if msg.lstrip(b':').upper().startswith(b'FORM'):
+			self.format = None
+		return TelepythicDevice.write(self,msg)
+		
+	def set_format(self, format=b'REAL,32'):
+		"""Set the data format for trace transfers, unless it is already set"""
+		if self.format != format:
+			self.write(b'FORM '+format)
+			self.format = format
 		
 	def traces(self):
 		"""Return a list of traces which are currently active"""
-		return [b'TR'+i for i in b'ABCDEF' if self.query(b'DISP:TRAC:STAT? TR'+i)]
+		state = self.query([b'DISP:TRAC:STAT? '+tr for tr in TRACES],batch=len(TRACES))
+		return [tr for tr in TRACES if state[b'DISP:TRAC:STAT? '+tr]]
 		
 	def get_trace(self,trace=None):
 		"""Download a trace of data from the unit"""
-		if trace is None:		trace = ""
+		if trace is None:		trace = b''
 		elif len(trace) == 1:	trace = b'TR'+trace
 		# create an array for wavelength values
-		npts = self.query(b'TRAC:POIN? '+trace)
-		start = self.query(b'TRAC:X:STAR? '+trace)*1e9    # in nm
-		stop = self.query(b'TRAC:X:STOP? '+trace)*1e9     # in nm
+		npts, start, stop = self._trace_axes([trace])[0]
 		X = np.linspace(start,stop,npts)
 		# download the spectrum in binary (fast) format
-		self.write(b'FORM REAL,32')
-		Y = self.ask_block(b'TRAC:DATA:Y? '+trace,'>f4')  # NB: big endian data
+		self.set_format(b'REAL,32')
+		Y = self._trace_data(trace)
 		# return a complete list
 		return np.transpose([X,Y])
 		
-	def get_pcl(self):
-		"""Download a PCL file from the unit **TESTING ONLY**"""
+	def get_all_traces(self,traces=None):
+		"""
+		Download all the active traces (or those specified) from the unit, returning a tuple (traces, X, Y) where X and Y are arrays of shape (len(traces), npts) holding the wavelengths (in nm) and values.
+		The settings of all the traces are queried in a single exchange, and each trace is received straight into its row of Y. If the traces have different lengths, the ends of the shorter rows are NaN.
+		"""
+		if traces is None:
+			traces = self.traces()
+		axes = self._trace_axes(traces)
+		npts = max([n for n,start,stop in axes] + [0])
+		X = np.full((len(traces),npts),np.nan)
+		Y = np.full((len(traces),npts),np.nan,dtype=np.float32)
+		self.set_format(b'REAL,32')
+		for i,(tr,(n,start,stop)) in enumerate(zip(traces,axes)):
+			X[i,:n] = np.linspace(start,stop,n)
+			self._trace_data(tr,Y[i])
+		return traces, X, Y
+		
+	def _trace_data(self,trace,out=None):
+		"""Download the values of the specified trace in binary format, optionally into the array "out" (see read_block)"""
+		return self.ask_block(b'TRAC:DATA:Y? '+trace,'>f4',out)  # NB: big endian data
+		
+	def _trace_axes(self,traces):
+		"""Query the number of points, start and stop wavelengths (in nm) of each of "traces" in a single exchange, returning a list of tuples"""
+		keys = [(b'TRAC:POIN? '+tr, b'TRAC:X:STAR? '+tr, b'TRAC:X:STOP? '+tr) for tr in traces]
+		resp = self.query(sum(keys,()),batch=3*len(traces))
+		return [(resp[n], resp[start]*1e9, resp[stop]*1e9) for n,start,stop in keys]
+		
+	def get_pcl(self,timeout=10):
+		"""Download a PCL file of the screen from the unit, waiting up to "timeout" seconds for it to be generated"""
 		# set into PCL output mode
 		self.write(b'HCOPY:DEV:LANG PCL')
 		# make sure it worked
@@ -46,24 +88,10 @@ class Agilent86140b(TelepythicDevice):
 		# request the data
 		self.write(b'HCOPY:DATA?')
 		# it needs some time to generate the file before it outputs
-		time.sleep(3)
-		# response is an INDEFINITE length binary block reponse
-		if self.bstream:	# we're using a bridge, this is a problem
-			# check the response is of the right form
-			assert self.read_raw(2) == b'#0', 'Expected indefinite block response'
-			# accumulate data until we stop getting fed it
-			data = b''
-			while self.dev.has_reply(timeout=1):
-				data = data + self.dev.read()
-		else:				# we're using VISA so we have a real EOI flag
-			# read raw data until EOI
-			data = self.dev.read_raw()
-			# check header
-			assert data[:2] == b'#0', 'Expected indefinite block response'
-			# return the rest
-			data = data[2:]
-		# there's a newline at the end that's unnecessary
-		return data[:-1]
+		if self.bstream:
+			self.dev.has_reply(timeout)
+		# response is an INDEFINITE length binary block reponse, read to the end
+		return self.read_block()
 
 
 if __name__ == '__main__':
@@ -88,7 +116,8 @@ if __name__ == '__main__':
 		navg = 0
 
 	# download all the data
-	tr = {i: dev.get_trace(i) for i in dev.traces()}
+	names, X, Y = dev.get_all_traces()
+	tr = {n: np.transpose([X[i],Y[i]]) for i,n in enumerate(names)}
 	# we're done, return to local control
 	dev.close()
 
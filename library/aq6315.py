@@ -28,14 +28,9 @@ npts = dev.query(b'SEGP?')   # number of points in sweep
 expectedlen = 12*npts+8     # estimate size of trace (ASCII format)
 
 def get_trace(cmd):
-    # device returns a comma-separated list of values
-    Y = dev.ask(cmd).strip().split(',')
-    # first value is an integer, listing how many values follow
-    n = int(Y.pop(0))
-    # check that it matches what we got (i.e. no data was lost)
-    assert len(Y) == n, 'Got %i elems, expected %i'%(len(Y),n)
-    # convert to a numpy array
-    return np.asarray(Y,'f')
+    # device returns a comma-separated list of values, where the first value is an integer listing how many values follow
+    # (which is checked, i.e. no data was lost)
+    return dev.ask_ascii_array(cmd,'f',count_prefix=True)
 
 import pylab
 pylab.clf()
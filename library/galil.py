@@ -6,20 +6,58 @@ References: http://www.galilmc.com/support/manuals/com47xxx/index.html
             http://www.galilmc.com/support/manuals/man47100.pdf
 """
 
-from telepythic import TelepythicDevice, TelnetInterface
+from telepythic import TelepythicDevice, TelnetInterface, UDPInterface, pooled, TelepythicError, QueryError
 from struct import unpack
-import re
+import numpy as np
+import re, select, socket, threading, time, hashlib
+
+# layout of the data record returned by QR (and sent periodically by DR)
+RECORD = np.dtype([
+    ('Header','<u2'), ('Size','<u2'),
+    ('Sample','<u2'), ('Error','u1'), ('Status','u1'),
+    ('AO','<u2',8),     # analog outputs (integer scaled)
+    ('AI','<u2',8),     # analog inputs
+    ('DO','<u2'),       # digital outputs (bit mask)
+    ('DI','<u2'),       # digital inputs
+    ('PC','<u4'),       # pulse counter
+    ('ZC','<i4'),       # user variable C
+    ('ZD','<i4'),       # user variable D
+])
+
+def _unpack_bits(x, nbits=16):
+    """Unpack an array of "nbits" integer masks into an array of bools with shape (len(x), nbits), least-significant bit first"""
+    x = np.ascontiguousarray(x, dtype='<u%i'%(nbits//8))
+    return np.unpackbits(x.view(np.uint8).reshape(-1,nbits//8), axis=1, bitorder='little').view(bool)
+
+def _program_lines(program):
+    """Split a program into its non-empty lines, without surrounding whitespace"""
+    if hasattr(program,'encode'):
+        program = program.encode()
+    return [l.strip() for l in program.splitlines() if l.strip()]
+
+def program_hash(program):
+    """Return a hash of the program (as a hex string), which ignores line endings and surrounding whitespace so that a program compares equal to the copy uploaded from the controller"""
+    return hashlib.sha1(b'\n'.join(_program_lines(program))).hexdigest()
 
 class GalilRIO(TelepythicDevice):
-    def __init__(self,interface,**kwargs):
-        if isinstance(interface,str):
-            interface = TelnetInterface(
+    def __init__(self,interface,udp=False,**kwargs):
+        """Connect to the controller through "interface", or if it is a host name, through a Telnet connection (or a UDPInterface if "udp" is True, for lower latency)"""
+        if isinstance(interface,str) and udp:
+            interface = UDPInterface(interface,
+                eom = b'\r\n',
+                prompt = [b':',b'?'],
+                **kwargs)
+        elif isinstance(interface,str):
+            # reuse a pooled connection if available
+            interface = pooled(TelnetInterface,
                 host = interface,
                 eom = b'\r\n',        # carriage return with newline
                 prompt = [b':',b'?'], # ":" denotes success, "?" denotes failure
                 initial = b'EO 0',    # turn echo off on connection
                 **kwargs)
         TelepythicDevice.__init__(self,interface)
+        # bytes of program data transferred by the last get_program() or put_program()
+        self.last_transfer = 0
         
     def query_error(self):
         """
@@ -33,7 +71,7 @@ class GalilRIO(TelepythicDevice):
         Query the last error code and get a description.
         Note that making this call resets the error register
         """
-        resp = self.ask(b'TC1').strip().split(' ',1)
+        resp = self.ask(b'TC1').strip().split(b' ',1)
         code = int(resp[0])
         if code == 0: return None
         return (code,resp[1])
@@ -72,6 +110,13 @@ class GalilRIO(TelepythicDevice):
             'ZD': zd    # user variable D
         }
     
+    def stream(self,period,port=23,capacity=4096):
+        """
+        Start streaming data records from the controller (with the DR command) every "period" samples, and return the GalilStream which receives them.
+        The records are sent to a dedicated UDP socket (to "port" on the controller), and decoded in batches on a background thread.
+        """
+        return GalilStream(self,period,port,capacity)
+    
     def get_handles(self):
         """
         Query the device's ethernet handles and return a dictionary of tuples with entries as follows:
@@ -94,13 +139,232 @@ class GalilRIO(TelepythicDevice):
     def get_program(self,split=False):
         """
         Instruct unit to upload its program to the connected host. If "split" is True, newlines are split for readability of compacted programs.
+        The program is received in bulk, only checking the end of the data received for the terminator. The number of bytes received is recorded in "last_transfer".
         """
-        self.write(b'UL')
-        data = ''
-        while not data.endswith(b'\x1a'):    # terminates with Ctrl+Z
-            data += self.read()
-        data = data[:-1].strip()
+        try:
+            with self.mutex:
+                self.dev.write(b'UL')
+                if hasattr(self.dev,'read_until_end'):
+                    # terminates with Ctrl+Z, followed by the prompt
+                    data = self.dev.read_until_end(b'\x1a:')
+                else:
+                    data = bytearray()
+                    while not data.endswith(b'\x1a'):
+                        data += self.dev.read()
+                    del data[-1:]
+        except Exception as e:
+            raise QueryError(self.dev, e, b'UL')
+        self.last_transfer = len(data)
+        data = bytes(data).strip()
         if split:
-            data = data.replace(';','\n')
+            data = data.replace(b';',b'\n')
         return data
-        
\ No newline at end of file
+    
+    def put_program(self,program,force=False):
+        """
+        Download "program" (a string of lines) to the unit, replacing its current program, and return the number of bytes sent.
+        Unless "force" is True, the current program is uploaded first and the download is skipped (returning 0) if it is the same, as per program_hash().
+        The total number of bytes transferred (including the upload) is recorded in "last_transfer".
+        Raises a TelepythicError if the unit reports an error in the program.
+        """
+        lines = _program_lines(program)
+        with self.mutex:
+            uploaded = 0
+            if not force:
+                same = program_hash(self.get_program()) == program_hash(b'\n'.join(lines))
+                uploaded = self.last_transfer
+                if same:
+                    return 0
+            # clear the error code, to check the download
+            self.get_error()
+            # the program follows DL in the same message, and ends with a backslash
+            data = b'\r'.join([b'DL'] + lines + [b'\\'])
+            n = self.write(data)
+            self.last_transfer = uploaded + n
+            err = self.get_error()
+        if err is not None:
+            raise TelepythicError(self.dev,None,'Program download to {device} failed with error %i: %s'%(err[0],err[1].decode()))
+        return n
+
+
+class RecordBuffer:
+    """A growable columnar store of data records, filled by GalilStream"""
+    def __init__(self,capacity=4096):
+        """
+        Create an empty buffer with space for "capacity" records, which is doubled whenever it is full.
+        Each column is an array indexed by record (e.g. buf['AI'] has shape (len(buf), 8)). The columns are the fields of RECORD except the header, with "DO" and "DI" unpacked into arrays of bools, plus "Time" (when each record was received).
+        """
+        self.count = 0
+        self.columns = {'Time': np.empty(capacity)}
+        for name in RECORD.names[2:]:
+            dtype = RECORD.fields[name][0]
+            if name in ('DO','DI'):
+                self.columns[name] = np.empty((capacity,16),dtype=bool)
+            else:
+                self.columns[name] = np.empty((capacity,)+dtype.shape,dtype=dtype.base)
+    
+    def __len__(self):
+        return self.count
+    
+    def __getitem__(self,name):
+        return self.columns[name][:self.count]
+    
+    def keys(self):
+        return self.columns.keys()
+    
+    def append(self,recs,times):
+        """Append the array of records "recs" (of dtype RECORD) received at "times" (an array of timestamps)"""
+        n, k = self.count, len(recs)
+        if n+k > len(self.columns['Time']):
+            self._grow(max(2*len(self.columns['Time']),n+k))
+        self.columns['Time'][n:n+k] = times
+        for name in RECORD.names[2:]:
+            if name in ('DO','DI'):
+                self.columns[name][n:n+k] = _unpack_bits(recs[name])
+            else:
+                self.columns[name][n:n+k] = recs[name]
+        self.count += k
+    
+    def copy(self,start=0,stop=None):
+        """Return a dict of copies of the columns, for the records from "start" to "stop" (default: the end)"""
+        if stop is None:
+            stop = self.count
+        return dict([(name,col[start:stop].copy()) for name,col in self.columns.items()])
+    
+    def _grow(self,capacity):
+        for name, col in self.columns.items():
+            new = np.empty((capacity,)+col.shape[1:],dtype=col.dtype)
+            new[:self.count] = col[:self.count]
+            self.columns[name] = new
+
+
+class GalilStream:
+    """Data records sent periodically by a GalilRIO, created by GalilRIO.stream()"""
+    def __init__(self,rio,period,port=23,capacity=4096,batch=256):
+        """
+        Open a UDP socket to the controller of "rio", instruct it to send a data record to the socket every "period" samples, and start receiving them on a background thread.
+        Up to "batch" records waiting on the socket are received and decoded at once, and appended to "records" (a RecordBuffer).
+        
+        Records are obtained in order with get(), or all at once from "records" (after stop(), or while holding "cond"). Datagrams which are not data records are counted in "invalid".
+        """
+        self.rio = rio
+        host = getattr(rio.dev,'host',None)
+        if host is None:
+            raise TelepythicError(rio.dev,None,'Data records can only be streamed from an Ethernet connection to {device}')
+        self.records = RecordBuffer(capacity)
+        self.next = 0           # index of the next record to be returned by get()
+        self.invalid = 0
+        self.error = None
+        self.done = False
+        # receive buffer for a batch of records
+        # (with room to detect a datagram which is too long)
+        self.batch = batch
+        self.raw = np.zeros(batch+1,dtype=RECORD)
+        self.times = np.zeros(batch)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.settimeout(1)
+        try:
+            self.sock.connect((host,port))
+            # find which of the controller's handles this socket is connected to
+            M = re.search(b'IH([A-Z])',self._command(b'WH'))
+            assert M is not None, 'Unknown response to WH'
+            self.handle = M.group(1)
+            self._command(b'DR %i,%i'%(period,ord(self.handle)-ord('A')))
+        except:
+            self.sock.close()
+            raise
+        self.cond = threading.Condition()
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        self.stop()
+    
+    def get(self,timeout=None):
+        """
+        Return a dict of the columns (see RecordBuffer) of the records received since the previous call.
+        Blocks until a record is available, returning None if the stream has finished (or "timeout" seconds elapsed). Raises the error which stopped the stream, if any.
+        """
+        with self.cond:
+            if timeout is None:
+                while self.next >= len(self.records) and not self.done:
+                    self.cond.wait()
+            elif self.next >= len(self.records) and not self.done:
+                self.cond.wait(timeout)
+            if self.next >= len(self.records):
+                if self.error is not None:
+                    raise self.error
+                return None
+            start, self.next = self.next, len(self.records)
+            return self.records.copy(start)
+    
+    def stop(self):
+        """Stop the controller sending records, close its handle and wait for the background thread to finish. Records already received remain in "records"."""
+        self.stopping.set()
+        self.thread.join()
+        try:
+            self._command(b'DR 0')
+        finally:
+            self.sock.close()
+            # free the handle, the controller has only a few (there is no reply other than the prompt)
+            self.rio.write(b'IH'+self.handle+b'=>-1')
+        if self.error is not None:
+            raise self.error
+    
+    def _command(self,cmd):
+        """Send "cmd" to the controller on the UDP socket and return its reply, ignoring any data records"""
+        try:
+            self.sock.send(cmd+b'\r')
+            while 1:
+                data = self.sock.recv(65536)
+                if len(data) == RECORD.itemsize:
+                    continue
+                if data.endswith(b'?'):
+                    raise QueryError(self.rio.dev,None,cmd)
+                if data.endswith(b':'):
+                    return data[:-1].strip()
+        except socket.error as e:
+            raise TelepythicError(self.rio.dev,e,'No response to UDP command '+repr(cmd))
+    
+    def _receive(self):
+        """Receive the records waiting on the socket (up to the batch size) into "raw", returning how many were received, or 0 if stopped first"""
+        view = memoryview(self.raw.view(np.uint8))
+        size = RECORD.itemsize
+        k = 0
+        while k < self.batch:
+            if k == 0:
+                # wait for the first record
+                if self.stopping.is_set():
+                    return 0
+                if not select.select([self.sock],[],[],0.1)[0]:
+                    continue
+            elif not select.select([self.sock],[],[],0)[0]:
+                break
+            n = self.sock.recv_into(view[k*size:(k+1)*size+1])
+            if n != size:
+                self.invalid += 1
+                continue
+            self.times[k] = time.time()
+            k += 1
+        return k
+    
+    def _run(self):
+        try:
+            while 1:
+                k = self._receive()
+                if not k:
+                    break
+                with self.cond:
+                    self.records.append(self.raw[:k],self.times[:k])
+                    self.cond.notify_all()
+        except Exception as e:
+            self.error = e
+        finally:
+            with self.cond:
+                self.done = True
+                self.cond.notify_all()
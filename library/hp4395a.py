@@ -21,7 +21,8 @@ dev = TelepythicDevice(bridge)
 id = dev.id(expect=b"HEWLETT-PACKARD,4395A")
 
 # interrogate settings
-opts = dev.query([b'MEAS',b'BW',b'REFV',b'FMT',b'SWPT',b'SAUNIT',b'AVER',b'AVERFACT'])
+# (all in a single compound query to avoid a GPIB round trip per setting)
+opts = dev.query([b'MEAS',b'BW',b'REFV',b'FMT',b'SWPT',b'SAUNIT',b'AVER',b'AVERFACT'],batch=8)
 assert opts[b'SWPT'] in (b'LINF',b'LOGF'), 'Unknown sweep mode'
 
 # download trace
@@ -56,9 +56,7 @@ else:
 # get the spectrum
 if ascii_mode:
     # comma-separated value list, comma at the end
-    data = dev.ask(b'SPEC?'+trace, size=nbins*14)[:-1].split(',')
-    assert len(data) == nbins
-    spec = np.asarray(data,'f')
+    spec = dev.ask_ascii_array(b'SPEC?'+trace,'f',count=nbins)
 else:   # probably not working yet
     data = dev.ask(b'SPEB?'+trace, size=nbins*2)
     spec = np.fromstring(data,'<i2',count=nbins)
@@ -5,24 +5,125 @@ Connects to TekTronix TDS, DPO and MSO oscilloscopes, and provides a simple inte
 Programming guides: http://www.tek.com/search/apachesolr_search/programmer?filters=type%3A%28%22manual%22%29%20tid%3A1012
 """
 
-from telepythic import TelepythicDevice
+from telepythic import TelepythicDevice, QueryError
+from telepythic.schema import Schema, string, enum
 import numpy as np
+import re, threading, time
+
+# types of the WFMP? fields, any others are inferred
+PREAMBLE = Schema({
+    'BYT_N': int,   'BIT_N': int,   'ENC': enum,    'BN_F': enum,   'BYT_O': enum,
+    'NR_P': int,    'WFI': string,  'PT_F': enum,   'PT_O': int,
+    'XUN': string,  'XIN': float,   'XZE': float,
+    'YUN': string,  'YMU': float,   'YOF': float,   'YZE': float,
+})
+
+# commands which don't change the waveform preambles (as abbreviations of their headers)
+_KEEP_PREAMBLES = (b'HEAD',b'VERB',b'LOCK',b'UNL')
+
+def _changes_preambles(msg):
+    """Whether any of the commands in "msg" might change the WFMP? responses, i.e. isn't a query or one of _KEEP_PREAMBLES"""
+    for cmd in msg.split(b';'):
+        cmd = cmd.strip()
+        if cmd and not cmd.endswith(b'?') and not cmd.lstrip(b':').upper().startswith(_KEEP_PREAMBLES):
+            return True
+    return False
+
+def _channel_name(channel):
+    """Return the source name of "channel", which may be a channel number (e.g. 1 for b'CH1') or a source name"""
+    if isinstance(channel,int) or channel in b'1234':
+        channel = b'CH%i'%int(channel)
+    if not isinstance(channel,bytes):
+        raise TypeError("Invalid type for channel")
+    return channel.strip()
+
+def _parse_preamble(wfmo):
+    """Parse the response to WFMP? (with HEAD 1) into a dict of the settings"""
+    assert wfmo.startswith(b':WFMP'), 'Unknown response header'
+    return PREAMBLE.parse(wfmo[wfmo.find(b':',1)+1:])
+
+def _binary_format(wfmo):
+    """Return the numpy dtype of the binary curve data described by a preamble"""
+    return ('>' if wfmo['BYT_O'] == b'MSB' else '<') + 'i' + str(wfmo['BYT_N'])
+
+def _scale(wfmo,Y,dtype=np.float64):
+    """
+    Return the time axis and y-values of the raw curve data "Y" using the preamble "wfmo" from WFMP?, see TekScope.waveform().
+    Unless "dtype" is float64, the time axis is a TimeAxis. If "dtype" is None, "Y" is returned unscaled.
+    """
+    npts = len(Y)
+    if dtype is not None and np.dtype(dtype) == np.float64:
+        T = wfmo['XIN']*np.arange(0,npts) + wfmo['XZE']
+    else:
+        T = TimeAxis(npts,wfmo['XIN'],wfmo['XZE'])
+    if dtype is not None:
+        # scale in-place, so the only new array is the converted copy
+        Y = Y.astype(dtype)
+        Y -= wfmo['YOF']
+        Y *= wfmo['YMU']
+        Y += wfmo['YZE']
+    return T, Y
+
+
+class TimeAxis:
+    """The time axis of a waveform, T[i] = XZE + i*XIN, which is only computed for the elements indexed (or converted with np.asarray)"""
+    def __init__(self,npts,xin,xze):
+        self.npts = npts
+        self.xin = xin
+        self.xze = xze
+    
+    def __len__(self):
+        return self.npts
+    
+    def __repr__(self):
+        return 'TimeAxis(%i points from %g in steps of %g)'%(self.npts,self.xze,self.xin)
+    
+    @property
+    def shape(self):
+        return (self.npts,)
+    
+    def __getitem__(self,i):
+        if isinstance(i,slice):
+            return self.xze + self.xin*np.arange(*i.indices(self.npts))
+        if np.isscalar(i):
+            if i < 0: i += self.npts
+            if not 0 <= i < self.npts:
+                raise IndexError('Index out of range')
+            return self.xze + self.xin*i
+        i = np.arange(self.npts)[i]
+        return self.xze + self.xin*i
+    
+    def __array__(self,dtype=None,copy=None):
+        T = self[:]
+        return T if dtype is None else T.astype(dtype)
 
 class TekScope(TelepythicDevice):
     """Helper class for communicating with TekTronix digital oscilloscopes."""
     def __init__(self,interface,**kwargs):
-        """Connect to scope over specified interface. If "interface" is string, connect as a telnet instance"""
+        """Connect to scope over specified interface. If "interface" is string, connect as a telnet instance (reusing a pooled connection if available)"""
         if isinstance(interface,str):
-            from telepythic import TelnetInterface
-            interface = TelnetInterface(
+            from telepythic import TelnetInterface, pooled
+            interface = pooled(TelnetInterface,
                 host = interface,
                 port = 4000,
                 eom = b'\n',
                 prompt = b'> ',
                 **kwargs)
         TelepythicDevice.__init__(self,interface)
+        # parsed WFMP? responses by channel, see preambles()
+        self.cache = {}
         # turn off verbose modes
         self.write(b'VERB 0; HEAD 0')
+    
+    def write(self,msg):
+        """Write the specified string to the scope. Any command other than a query may change the settings, so also discards the cached preambles (unless the commands are known not to, e.g. HEAD)."""
+        if _changes_preambles(msg):
+            self.invalidate()
+        return TelepythicDevice.write(self,msg)
+    
+    def invalidate(self):
+        """Discard the cached preambles, e.g. after the settings were changed on the front panel"""
+        self.cache.clear()
         
     def channels(self,all=True):
         """Return a dictionary of the channels supported by this scope and whether they are currently displayed.
@@ -45,16 +146,20 @@ class TekScope(TelepythicDevice):
                 vals[name] = visible
         return vals
 
-    def waveform(self,channel=None,ascii_mode=False):
+    def waveform(self,channel=None,ascii_mode=False,out=None,dtype=np.float64,width=2):
         """Downloads the active (or the specified) channel from the scope in binary mode (unless "ascii_mode" is True).
-        Returns a tuple (A,T,Y) consisting of channel attributes as queried with WFMP? and 1D arrays of time and y-values"""
+        Returns a tuple (A,T,Y) consisting of channel attributes as queried with WFMP? and 1D arrays of time and y-values.
+        
+        The y-values are scaled to "dtype" (e.g. np.float32 to halve the memory required), or if "dtype" is None the raw integer samples of "width" bytes (1 or 2) are returned, to be scaled by YMU, YOF and YZE in A.
+        Unless "dtype" is float64, T is a TimeAxis which only computes the times that are indexed.
+        
+        If "out" is specified, the raw integer samples are written straight into it without scaling (see read_block() for the supported destinations, e.g. a filename or h5py dataset).
+        In that case T is None and Y is "out"; the samples are scaled by YMU, YOF and YZE in A."""
+        if out is not None and ascii_mode:
+            raise ValueError("Output destination requires binary mode")
         # select channel if required
         if channel is not None:
-            if isinstance(channel,int) or channel in b'1234':
-                channel = b'CH'+str(channel)
-            if not isinstance(channel,str):
-                raise TypeError("Invalid type for channel")
-            self.write(b'DAT:SOU '+channel.strip())
+            self.write(b'DAT:SOU '+_channel_name(channel))
             # check that it worked
             try: self.ask(b'DAT:SOU?') # should timeout if it failed
             except: raise ValueError("Invalid channel")
@@ -63,27 +168,12 @@ class TekScope(TelepythicDevice):
         if ascii_mode:
             self.write(b'DAT:ENC ASCII')
         else:
-            self.write(b'DAT:ENC RIB; WID 2')
+            self.write(b'DAT:ENC RIB; WID %i'%width)
         # want to enable HEAD for settings names
         prev = self.ask(b'HEAD?')
         self.write(b'HEAD 1')
         # create a dict of all the settings
-        wfmo = self.ask(b'WFMP?')
-        assert wfmo.startswith(b':WFMP'), 'Unknown response header'
-        wfmo_vals = wfmo[wfmo.find(':',1)+1:].split(b';')
-        
-        def parse(x):
-            try:    return int(x)
-            except: pass
-            try:    return float(x)
-            except: pass
-            if x[0] == b'"': return x[1:x.rfind(b'"')]
-            return x
-        
-        wfmo = {}
-        for x in wfmo_vals:
-            name, val = x.split(b' ',1)
-            wfmo[str(name)] = parse(val)
+        wfmo = _parse_preamble(self.ask(b'WFMP?'))
         npts = wfmo['NR_P']
         assert npts > 0
         
@@ -92,30 +182,256 @@ class TekScope(TelepythicDevice):
         self.flush()
         # get the raw curve data
         if ascii_mode:
-            data = self.ask(b'CURV?')
-            Y = np.fromstring(data,sep=b',')
+            Y = self.ask_ascii_array(b'CURV?',count=npts)
         else:
-            fmt = ('>' if wfmo['BYT_O'] == b'MSB' else '<') + 'i' + str(wfmo['BYT_N'])
-            Y = self.ask_block(b'CURV?',format=fmt)
+            Y = self.ask_block(b'CURV?',format=_binary_format(wfmo),out=out)
         assert len(Y) == npts, 'Incorrect response size'
-        # transform the data
-        T = wfmo['XIN']*np.arange(0,npts) + wfmo['XZE']
-        Y = wfmo['YMU']*(Y - wfmo['YOF']) + wfmo['YZE']
+        if out is None:
+            # transform the data
+            T, Y = _scale(wfmo,Y,dtype)
+        else:
+            T = None
         # reset HEAD
         self.write(b'HEAD '+prev)
         return wfmo, T, Y
+    
+    def preambles(self,channels):
+        """Return a dict of the settings (as per WFMP?) of each of "channels" in binary mode, querying those which aren't cached in a single transaction"""
+        names = [_channel_name(ch) for ch in channels]
+        missing = [ch for ch in names if ch not in self.cache]
+        if len(missing):
+            msg = b'DAT:ENC RIB;WID 2;:HEAD 1' + b''.join([b';:DAT:SOU '+ch+b';:WFMP?' for ch in missing]) + b';:HEAD 0'
+            resp = re.split(b';(?=:WFMP)',self.ask(msg))
+            assert len(resp) == len(missing), 'Incorrect number of preambles'
+            for ch, wfmo in zip(missing,resp):
+                self.cache[ch] = _parse_preamble(wfmo)
+        return {ch: self.cache[name] for ch,name in zip(channels,names)}
+    
+    def waveforms(self,channels=None,out=None,dtype=np.float64):
+        """Downloads several channels (default: those currently displayed) from the scope in binary mode.
+        Returns a dict mapping each channel to a tuple (A,T,Y) as per waveform(), including the "dtype" option.
+        
+        The preambles are cached (see preambles() and invalidate()), so once known all the channels are downloaded in a single transaction.
+        If "out" is specified, it is a dict mapping channels to destinations for their raw samples, as per waveform()."""
+        if channels is None:
+            channels = list(self.channels(False))
+        out = out or {}
+        with self.mutex:
+            for attempt in range(2):
+                wfmo = self.preambles(channels)
+                Y = self._curves(channels,wfmo,out)
+                if all([len(Y[ch]) == wfmo[ch]['NR_P'] for ch in channels]):
+                    break
+                # the record length has changed since the preambles were cached
+                self.invalidate()
+            else:
+                raise AssertionError('Incorrect response size')
+        result = {}
+        for ch in channels:
+            if ch in out:
+                result[ch] = (dict(wfmo[ch]), None, Y[ch])
+            else:
+                result[ch] = (dict(wfmo[ch]),) + _scale(wfmo[ch],Y[ch],dtype)
+        return result
+    
+    def _curves(self,channels,wfmo,out,arm=False):
+        """Download the raw curve data of "channels" with preambles "wfmo", returning a dict of arrays.
+        If "arm" is True, the next acquisition is started as soon as the curves are sent, and the reply to *OPC? (sent when it completes) is left to be read by the caller."""
+        Y = {}
+        if not self.bstream:
+            # VISA can't read part of a response, so need a transaction per channel
+            for ch in channels:
+                Y[ch] = self.ask_block(b'DAT:ENC RIB;WID 2;:DAT:SOU '+_channel_name(ch)+b';:CURV?',_binary_format(wfmo[ch]),out.get(ch))
+            if arm:
+                TelepythicDevice.write(self,b'ACQ:STATE RUN;*OPC?')
+            return Y
+        # the curves are returned separated by ';', and the *OPC? reply consumes the end of the response
+        msg = b'DAT:ENC RIB;WID 2' + b''.join([b';:DAT:SOU '+_channel_name(ch)+b';:CURV?' for ch in channels])
+        msg += b';:ACQ:STATE RUN;*OPC?' if arm else b';*OPC?'
+        try:
+            with self._measure(msg):
+                # discard anything left over from previous commands (e.g. a prompt)
+                if hasattr(self.dev,'flush'):
+                    self.dev.flush(0)
+                self.dev.write(msg)
+                for ch in channels:
+                    if len(Y):
+                        assert self.read_raw(1) == b';', 'Unexpected response separator'
+                    Y[ch] = self.read_block(_binary_format(wfmo[ch]),out.get(ch))
+                if not arm:
+                    assert self.dev.read().endswith(b'1'), 'Unexpected response'
+        except Exception as e:
+            raise QueryError(self.dev, e, msg)
+        return Y
+    
+    def stream(self,channels=None,n=None,depth=64):
+        """Start acquiring "n" (default: unlimited) single-sequence acquisitions of "channels" (default: those currently displayed) on a background thread, and return the TekStream which receives them.
+        Each acquisition is downloaded as raw integer samples into a ring buffer of "depth" records, see TekStream. The scope is used exclusively by the stream until it is stopped."""
+        if channels is None:
+            channels = list(self.channels(False))
+        return TekStream(self,channels,n,depth)
 
     def lock(self,locked=True):
         """Lock (or unlock) the scope's front panel"""
         self.write(b'LOCK ALL' if locked else b'LOCK NONE')
 
 
+class TekStream:
+    """A continuous sequence of acquisitions from a TekScope, created by TekScope.stream()"""
+    def __init__(self,scope,channels,n=None,depth=64):
+        """
+        Start acquiring from "scope" on a background thread. Each acquisition is downloaded into the next record of the ring buffer "buffer", an array of raw samples with shape (depth, len(channels), points).
+        The next acquisition is armed in the same message that downloads the previous one, so the scope waits for a trigger while the data is being stored.
+        
+        Records are obtained in order with get() (or by iterating over the stream). If the consumer falls more than "depth" records behind, the oldest unread records are overwritten and counted in "overruns".
+        """
+        self.scope = scope
+        self.channels = list(channels)
+        self.n = n
+        self.wfmo = scope.preambles(self.channels)
+        npts = set([wfmo['NR_P'] for wfmo in self.wfmo.values()])
+        fmts = set([_binary_format(wfmo) for wfmo in self.wfmo.values()])
+        if len(npts) != 1 or len(fmts) != 1:
+            raise ValueError('Channels must have the same record length and format')
+        self.buffer = np.empty((depth,len(self.channels),npts.pop()),dtype=fmts.pop())
+        self.times = np.zeros(depth)
+        self.count = 0          # number of records completed
+        self.next = 0           # index of the next record to be returned by get()
+        self.overruns = 0
+        self.error = None
+        self.done = False
+        self.cond = threading.Condition()
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        self.stop()
+    
+    def __iter__(self):
+        while 1:
+            rec = self.get()
+            if rec is None:
+                return
+            yield rec
+    
+    def get(self,timeout=None):
+        """
+        Return the next record as a tuple (index, time, data), where "data" is a copy of the raw samples with shape (channels, points), see scale().
+        Blocks until a record is available, returning None if the stream has finished (or "timeout" seconds elapsed). Raises the error which stopped the stream, if any.
+        """
+        with self.cond:
+            if timeout is None:
+                while self.next >= self.count and not self.done:
+                    self.cond.wait()
+            elif self.next >= self.count and not self.done:
+                self.cond.wait(timeout)
+            if self.next >= self.count:
+                if self.error is not None:
+                    raise self.error
+                return None
+            k = self.next
+            slot = k % len(self.buffer)
+            self.next += 1
+            return k, self.times[slot], self.buffer[slot].copy()
+    
+    def scale(self,data,dtype=np.float64):
+        """Return the time axis and y-values of the raw samples "data" of a record (see get()), as per TekScope.waveform()"""
+        Y = np.empty(data.shape,dtype=dtype)
+        for i, ch in enumerate(self.channels):
+            T, Y[i] = _scale(self.wfmo[ch],data[i],dtype)
+        return T, Y
+    
+    def stop(self):
+        """
+        Stop acquiring and wait for the background thread to finish. Records already acquired can still be obtained with get().
+        The acquisition in progress is abandoned with a device clear if the interface supports it (e.g. GPIB); otherwise the scope will not respond until it has triggered.
+        """
+        self.stopping.set()
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+    
+    def _claim(self):
+        """Return the ring buffer slot for the next record, dropping the oldest unread record if the buffer is full"""
+        with self.cond:
+            if self.count - self.next >= len(self.buffer):
+                self.next += 1
+                self.overruns += 1
+            return self.count % len(self.buffer)
+    
+    def _wait(self):
+        """Wait for the *OPC? reply signalling an acquisition has completed, returning False if stopped first"""
+        dev = self.scope.dev
+        while not self.stopping.is_set():
+            if not self.scope.bstream or dev.has_reply(0.1):
+                assert self.scope.read().endswith(b'1'), 'Unexpected response'
+                return True
+        return False
+    
+    def _run(self):
+        scope = self.scope
+        armed = False
+        try:
+            with scope.mutex:
+                stopafter = scope.ask(b'ACQ:STOPA?')
+                TelepythicDevice.write(scope,b'ACQ:STOPA SEQ;:ACQ:STATE RUN;*OPC?')
+                armed = True
+                while self.n is None or self.count < self.n:
+                    if not self._wait():
+                        break
+                    t = time.time()
+                    slot = self._claim()
+                    # only arm another acquisition if it's wanted
+                    armed = self.n is None or self.count+1 < self.n
+                    out = dict(zip(self.channels,self.buffer[slot]))
+                    Y = scope._curves(self.channels,self.wfmo,out,armed)
+                    if any([len(y) != self.buffer.shape[2] for y in Y.values()]):
+                        raise ValueError('Record length changed during acquisition')
+                    with self.cond:
+                        self.times[slot] = t
+                        self.count += 1
+                        self.cond.notify_all()
+                if armed:
+                    # abandon the acquisition in progress
+                    if hasattr(scope.dev,'clear'):
+                        scope.dev.clear()
+                    TelepythicDevice.write(scope,b'ACQ:STATE STOP')
+                    scope.flush()
+                TelepythicDevice.write(scope,b'ACQ:STOPA '+stopafter)
+        except Exception as e:
+            self.error = e
+        finally:
+            with self.cond:
+                self.done = True
+                self.cond.notify_all()
+
+
 if __name__ == '__main__':
     import _cmdline
-    ifc = _cmdline.parse("Tektronix digital oscilloscopes",telnet=True,port=4000)
+    ifc, output = _cmdline.parse_output("Tektronix digital oscilloscopes",telnet=True,port=4000)
     dev = TekScope(ifc)
-    import pylab as pyl
-    for ch in dev.channels(True):
-        wfmo, T, Y = dev.waveform(ch)
-        pyl.plot(T,Y)
-    pyl.show()
+    channels = list(dev.channels(False))
+    if output is None:
+        import pylab as pyl
+        for ch, (wfmo, T, Y) in dev.waveforms(channels).items():
+            pyl.plot(T,Y,label=ch)
+        pyl.show()
+    elif output.endswith('.h5') or output.endswith('.hdf5'):
+        # stream the raw samples of each visible channel straight into the file
+        import h5py
+        with h5py.File(output,'w') as F:
+            D = {ch: F.create_dataset(ch.decode(),shape=(0,),maxshape=(None,),dtype='i2',chunks=True) for ch in channels}
+            for ch, (wfmo, T, Y) in dev.waveforms(channels,out=D).items():
+                D[ch].attrs.update(wfmo)
+    else:
+        # memory-mapped numpy file per visible channel, with its preamble (for scaling the raw samples) in a JSON file alongside
+        import os, json
+        root, ext = os.path.splitext(output)
+        for ch, (wfmo, T, Y) in dev.waveforms(channels,out={ch: '%s_%s.npy'%(root,ch.decode()) for ch in channels}).items():
+            with open('%s_%s.json'%(root,ch.decode()),'w') as F:
+                json.dump({k: v.decode() if isinstance(v,bytes) else v for k,v in wfmo.items()},F,indent=1)
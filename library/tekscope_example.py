@@ -23,10 +23,11 @@ with h5py.File("scope.h5","w") as F:
 		# if the channel is enabled, download it
 		if chans[ch]:
 			print 'Downloading',ch
-			wfmo, T, Y = scope.waveform(ch)
-			# save it to the file
-			D = F.create_dataset(ch,data=np.vstack([T,Y]).T)
+			# stream the raw samples straight into the file
+			D = F.create_dataset(ch,shape=(0,),maxshape=(None,),dtype='i2',chunks=True)
+			wfmo, T, Y = scope.waveform(ch,out=D)
 			D.attrs.update(wfmo)
-			# plot it
-			pyl.plot(T,Y,col)
+			# plot it (scaling per the waveform preamble)
+			T = wfmo['XIN']*np.arange(len(D)) + wfmo['XZE']
+			pyl.plot(T,wfmo['YMU']*(D[:] - wfmo['YOF']) + wfmo['YZE'],col)
 pyl.show()
@@ -0,0 +1,187 @@
+"""
+TELEPYTHIC -- a python interface to test equipment
+Copyright 2014-2020 by Martijn Jasperse
+https://github.com/mjasperse/telepythic
+
+Optional instrumentation of device I/O, enabled with TelepythicDevice.enable_metrics().
+"""
+import math, socket, threading
+from timeit import default_timer as clock
+
+class Histogram:
+    # bins are logarithmic in powers of two, starting at "base"
+    nbins = 32
+    def __init__(self, base=1e-6):
+        """A fixed-memory histogram of positive values (e.g. durations in seconds), with power-of-two bins from "base" upwards"""
+        self.base = base
+        self.reset()
+    
+    def reset(self):
+        """Discard all recorded values"""
+        self.bins = [0]*(self.nbins+1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+    
+    def add(self, x):
+        """Record the value x"""
+        k = 0 if x < self.base else min(self.nbins, int(math.log(x/self.base,2))+1)
+        self.bins[k] += 1
+        self.count += 1
+        self.total += x
+        if self.min is None or x < self.min: self.min = x
+        if self.max is None or x > self.max: self.max = x
+    
+    def edges(self):
+        """Return the upper edge of each bin (the final bin is unbounded)"""
+        return [self.base*2**k for k in range(self.nbins)] + [float('inf')]
+    
+    def quantile(self, q):
+        """Estimate the "q" quantile (0 to 1) as the upper edge of the bin containing it"""
+        if not self.count:
+            return None
+        n = q*self.count
+        for k, edge in enumerate(self.edges()):
+            n -= self.bins[k]
+            if n <= 0:
+                return min(edge, self.max)
+        return self.max
+    
+    def snapshot(self):
+        """Return a dict summarising the recorded values"""
+        return {
+            'count': self.count,
+            'mean': self.total/self.count if self.count else None,
+            'min': self.min,
+            'median': self.quantile(0.5),
+            'p90': self.quantile(0.9),
+            'max': self.max,
+            'bins': list(self.bins),
+        }
+
+
+class IOCounters:
+    __slots__ = ('recvs','bytes_in','bytes_out','first_byte')
+    def __init__(self):
+        """Counters updated by an interface as it sends and receives, see TCPInterface.stats"""
+        self.recvs = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.first_byte = None
+    
+    def sent(self, n):
+        """Record that "n" bytes were sent, after which the next byte received is the first of a new reply"""
+        self.bytes_out += n
+        self.first_byte = None
+    
+    def received(self, n):
+        """Record a receive of "n" bytes"""
+        self.recvs += 1
+        self.bytes_in += n
+        if self.first_byte is None:
+            self.first_byte = clock()
+
+
+class CommandStats:
+    def __init__(self):
+        """Statistics for a single command mnemonic"""
+        self.latency = Histogram()
+        self.first_byte = Histogram()
+        self.count = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.recvs = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+    
+    def snapshot(self):
+        """Return a dict of the statistics"""
+        return {
+            'count': self.count,
+            'timeouts': self.timeouts,
+            'errors': self.errors,
+            'recvs': self.recvs,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'latency': self.latency.snapshot(),
+            'first_byte': self.first_byte.snapshot(),
+        }
+
+
+def mnemonic(query):
+    """Return the command mnemonic of "query", e.g. b'TRAC:POIN?' for b'TRAC:POIN? TRA'"""
+    if hasattr(query,'encode'):
+        query = query.encode()
+    return query.strip().split(b' ',1)[0].split(b';',1)[0]
+
+class Metrics:
+    def __init__(self):
+        """Per-command I/O statistics, recorded by measure()"""
+        self.commands = {}
+        self.mutex = threading.Lock()
+    
+    def measure(self, query, counters=None):
+        """Return a context manager which records the round trip of "query", using the interface "counters" (an IOCounters instance) if available"""
+        return _Measurement(self, query, counters)
+    
+    def snapshot(self):
+        """Return a dict of the statistics of each command mnemonic"""
+        with self.mutex:
+            return {k: v.snapshot() for k,v in self.commands.items()}
+    
+    def reset(self):
+        """Discard all recorded statistics"""
+        with self.mutex:
+            self.commands.clear()
+    
+    def _record(self, query, latency, first_byte, recvs, bytes_in, bytes_out, error):
+        with self.mutex:
+            key = mnemonic(query)
+            stats = self.commands.get(key)
+            if stats is None:
+                stats = self.commands[key] = CommandStats()
+            stats.count += 1
+            stats.latency.add(latency)
+            if first_byte is not None:
+                stats.first_byte.add(first_byte)
+            stats.recvs += recvs
+            stats.bytes_in += bytes_in
+            stats.bytes_out += bytes_out
+            if error is not None:
+                if isinstance(error,socket.timeout) or getattr(error,'abbreviation',None) == 'VI_ERROR_TMO':
+                    stats.timeouts += 1
+                else:
+                    stats.errors += 1
+
+
+class _Measurement:
+    def __init__(self, metrics, query, counters):
+        self.metrics = metrics
+        self.query = query
+        self.counters = counters
+    
+    def __enter__(self):
+        c = self.counters
+        if c is not None:
+            self.start_counts = (c.recvs, c.bytes_in, c.bytes_out)
+        self.start = clock()
+    
+    def __exit__(self, exc_type, exc, tb):
+        latency = clock() - self.start
+        c = self.counters
+        if c is None:
+            first_byte, recvs, bytes_in, bytes_out = None, 0, 0, len(self.query)
+        else:
+            first_byte = None if c.first_byte is None or c.first_byte < self.start else c.first_byte - self.start
+            recvs, bytes_in, bytes_out = [a-b for a,b in zip((c.recvs, c.bytes_in, c.bytes_out), self.start_counts)]
+        self.metrics._record(self.query, latency, first_byte, recvs, bytes_in, bytes_out, exc)
+        return False
+
+
+class _NoMeasurement:
+    """A do-nothing context manager, used when metrics are disabled"""
+    def __enter__(self):                    pass
+    def __exit__(self, exc_type, exc, tb):  return False
+
+no_measurement = _NoMeasurement()
@@ -0,0 +1,137 @@
+"""
+TELEPYTHIC -- a python interface to test equipment
+Copyright 2014-2020 by Martijn Jasperse
+https://github.com/mjasperse/telepythic
+"""
+import socket, select, threading, time
+
+def _alive(ifc):
+    """A cheap liveness probe, which checks the interface's socket has not been closed by the remote end (without sending anything)"""
+    sock = getattr(ifc,'sock',None)
+    if sock is None:
+        return False
+    try:
+        # readable with nothing to read means the remote end closed the connection
+        return not (select.select([sock],[],[],0)[0] and not sock.recv(1,socket.MSG_PEEK))
+    except (socket.error, ValueError):
+        return False
+
+def _discard(ifc):
+    """Close the interface, ignoring any errors"""
+    try:    ifc.close()
+    except: pass
+
+
+class PooledInterface:
+    def __init__(self, pool, key, factory, interface):
+        """
+        A connection obtained from a ConnectionPool, which behaves as the underlying interface.
+        If a write() fails because the connection was reset by the remote end, it reconnects transparently and writes again. Call release() to return the connection to the pool.
+        """
+        self.pool = pool
+        self.key = key
+        self.factory = factory
+        self.ifc = interface
+        # only offer write_parts() if the interface supports it, so that callers can test for it
+        if hasattr(interface,'write_parts'):
+            self.__dict__['write_parts'] = self._write_parts
+    
+    def __getattr__(self, name):
+        # only called for attributes not found on this instance, so pass on to the interface
+        if name == 'ifc':
+            raise AttributeError(name)
+        return getattr(self.ifc, name)
+    
+    def __setattr__(self, name, value):
+        # settings such as "stats" belong to the interface
+        if name in ('pool','key','factory','ifc'):
+            self.__dict__[name] = value
+        else:
+            setattr(self.ifc, name, value)
+    
+    def __str__(self):
+        return str(self.ifc)
+    
+    def write(self, msg):
+        """Write to the interface, reconnecting once if the connection was lost"""
+        return self._write('write', msg)
+    
+    def _write_parts(self, parts):
+        """Write the buffers in "parts" to the interface (see TCPInterface.write_parts), reconnecting once if the connection was lost"""
+        return self._write('write_parts', parts)
+    
+    def _write(self, func, msg):
+        try:
+            return getattr(self.ifc,func)(msg)
+        except socket.timeout:
+            raise
+        except socket.error:
+            self.reconnect()
+            return getattr(self.ifc,func)(msg)
+    
+    def reconnect(self):
+        """Replace the underlying connection with a new one, which keeps the "stats" and "mutex" of the old one"""
+        old = self.ifc
+        _discard(old)
+        self.ifc = self.factory()
+        for name in ('mutex','stats'):
+            if hasattr(old,name):
+                setattr(self.ifc,name,getattr(old,name))
+    
+    def release(self):
+        """Return the connection to the pool for reuse. The instance must not be used afterwards."""
+        if self.ifc is not None:
+            self.pool.release(self)
+
+
+class ConnectionPool:
+    def __init__(self, max_idle=300):
+        """
+        A pool of open interface connections, which are reused by later requests for a connection with identical arguments.
+        Each connection is only held by one user at a time. Idle connections are checked with a liveness probe before reuse, and closed after "max_idle" seconds.
+        """
+        self.max_idle = max_idle
+        # idle connections as a list of (time released, interface), keyed by constructor arguments
+        self.idle = {}
+        self.mutex = threading.Lock()
+    
+    def connect(self, cls, *args, **kwargs):
+        """Return a PooledInterface for the interface cls(*args,**kwargs), reusing an idle healthy connection if available"""
+        key = (cls, repr(args), repr(sorted(kwargs.items())))
+        factory = lambda: cls(*args,**kwargs)
+        interface = None
+        with self.mutex:
+            conns = self.idle.get(key,[])
+            while len(conns) and interface is None:
+                released, ifc = conns.pop()
+                if time.time() - released < self.max_idle and _alive(ifc):
+                    # discard any stale responses
+                    ifc.flush(0)
+                    interface = ifc
+                else:
+                    _discard(ifc)
+        if interface is None:
+            interface = factory()
+        return PooledInterface(self, key, factory, interface)
+    
+    def release(self, pooled):
+        """Return the connection held by "pooled" to the pool"""
+        with self.mutex:
+            self.idle.setdefault(pooled.key,[]).append((time.time(), pooled.ifc))
+        pooled.ifc = None
+    
+    def clear(self):
+        """Close all idle connections"""
+        with self.mutex:
+            for conns in self.idle.values():
+                for released, ifc in conns:
+                    _discard(ifc)
+            self.idle.clear()
+
+
+# the process-wide pool
+default_pool = ConnectionPool()
+
+def pooled(cls, *args, **kwargs):
+    """Connect to the interface cls(*args,**kwargs) through the process-wide connection pool, see ConnectionPool.connect()"""
+    return default_pool.connect(cls, *args, **kwargs)
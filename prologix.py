@@ -3,12 +3,45 @@ TELEPYTHIC -- a python interface to test equipment
 Copyright 2014-2020 by Martijn Jasperse
 https://github.com/mjasperse/telepythic
 """
+import re, time
 from .tcp import TCPInterface
 from .telepythic import TelepythicError, ConnectionError
 
+def _setup_commands(gpib, timeout, auto, assert_eoi, eos, eot=None):
+    """Return the list of commands which configure a Prologix bridge, see PrologixInterface"""
+    # what kind of eos to append?
+    if eos is None or eos == b'':    eos = 3
+    elif eos == b'\n':               eos = 2
+    elif eos == b'\r':               eos = 1
+    elif eos == b'\r\n':             eos = 0
+    elif not eos in (0,1,2,3):      raise ValueError('Unknown EOS mode')
+    if eot is not None and len(eot) != 1:
+        raise ValueError('EOT must be a single character')
+    cmds = [
+        b'++mode 1\n',                             # set controller mode
+        b'++read_tmo_ms %i\n'%int(timeout*1000),   # set timeout for reading gpib response (in ms)
+        b'++addr %i\n'%gpib,                       # set gpib address of device to connect to
+        b'++eoi %i\n'%assert_eoi,                  # assert eoi with every write?
+        b'++eos %i\n'%eos,                         # what kind of eos to append?
+        b'++auto %i\n'%auto,                       # attempt to read after every write?
+    ]
+    # append a character to mark EOI in responses?
+    if eot is None:
+        cmds.append(b'++eot_enable 0\n')
+    else:
+        cmds += [b'++eot_enable 1\n', b'++eot_char %i\n'%bytearray(eot)[0]]
+    return cmds
+
+# settings last sent to each bridge, keyed by (host,port), as a tuple (time, set of commands)
+_bridge_cache = {}
+
+def _escape(data):
+    """Escape the characters in binary "data" which would otherwise be interpreted by the Prologix (CR, LF, ESC and '+')"""
+    return re.sub(b'([\r\n\x1b+])',b'\x1b\\1',memoryview(data).cast('B').tobytes())
+
 class PrologixInterface(TCPInterface):
     _protocol = 'Prologix'
-    def __init__(self, gpib, host, port=1234, timeout=1, auto=True, assert_eoi=True, eos=None, poll=True):
+    def __init__(self, gpib, host, port=1234, timeout=1, auto=True, assert_eoi=True, eos=None, poll=True, cache=0, eot=None):
         """
         Connect to the Prologix Ethernet<->GPIB bridge at (host,port) and communicate with the device at the specified GPIB address. Attempts to poll the device after connection to ensure device is operating.
         
@@ -18,37 +51,41 @@ class PrologixInterface(TCPInterface):
         auto        -- automatically read after every write command, as opposed to issuing "++read" on every read command (default: True)
         assert_eoi  -- assert the EOI GPIB line with the last character sent (default: True)
         eos         -- string to append to signify End-Of-Send, must be one of '\\n', '\\r' or '\\r\\n' (default None)
+        poll        -- serial poll the device after connecting, or if 'defer' check the poll response on the first read rather than waiting for it here (default True)
+        cache       -- if this bridge was configured by a previous connection less than "cache" seconds ago, skip the identity check and only send the settings that changed (default 0)
+        eot         -- character the Prologix appends to responses when EOI is asserted, which then delimits responses instead of '\n' (e.g. to read indefinite-length binary blocks, see read_until_end). Must not occur in the responses (default None)
+        
+        The identity check and configuration are sent as a single message, so connecting costs a single network round trip.
         """
         # connect to prologix unit (prologix itself requires '\n' eom termination)
         TCPInterface.__init__(self,host,port,timeout,eom=b'\n')
+        self.auto = auto
+        self.eot = eot
+        if eot is not None:
+            self.term = eot
+        self.pending_poll = False
+        key = (self.host,port)
+        settings = _setup_commands(gpib,timeout,auto,assert_eoi,eos,eot)
+        # was this bridge configured recently?
+        cached = _bridge_cache.pop(key,None)
+        verify = cached is None or time.time() - cached[0] > cache
+        if verify:
+            msg = [b'++ver\n'] + settings
+        else:
+            msg = [cmd for cmd in settings if cmd not in cached[1]]
+        if poll:
+            msg.append(b'++spoll\n')
+        if len(msg):
+            self.write(b''.join(msg))
         # make sure it's what we expect
-        self.write(b'++ver\n')
-        if not self.read(True).startswith(b'Prologix GPIB'):
+        if verify and not self.read(True).startswith(b'Prologix GPIB'):
             raise ConnectionError(self,None,'Not a Prologix device')
-        
-        # set controller mode
-        self.write(b'++mode 1\n')
-        # set timeout for reading gpib response (in ms)
-        self.write(b'++read_tmo_ms %i\n'%int(timeout*1000))
-        # set gpib address of device to connect to
-        self.write(b'++addr %i\n'%gpib)
-        # assert eoi with every write?
-        self.write(b'++eoi %i\n'%assert_eoi)
-        # what kind of eos to append?
-        if eos is None or eos == b'':    eos = 3
-        elif eos == b'\n':               eos = 2
-        elif eos == b'\r':               eos = 1
-        elif eos == b'\r\n':             eos = 0
-        elif not eos in (0,1,2,3):      raise ValueError('Unknown EOS mode')
-        self.write(b'++eos %i\n'%eos)
-        # attempt to read after every write?
-        self.write(b'++auto %i\n'%auto)
-        self.auto = auto
-        
         # can we serial poll the device?
-        if poll:
-            try:    self.poll()
-            except: raise ConnectionError(self,None,'Device did not respond to poll')
+        if poll == 'defer':
+            self.pending_poll = True
+        elif poll:
+            self._check_poll()
+        _bridge_cache[key] = (time.time(), set(settings))
         
     def __del__(self):
         # clean up if possible
@@ -61,10 +98,57 @@ class PrologixInterface(TCPInterface):
         If the device was not configured in "auto" mode (see __init__), a "++read" command is issued.
         To read a response to a Prologix query (starting with "++"), set immediate to True.
         """
+        if self.pending_poll: self._check_poll()
+        if immediate: return self._read_bridge()
         # if we're not in auto mode, need to tell prologix to read
-        if not immediate and not self.auto: self.write(b'++read eoi\n')
+        if not self.auto: self.write(b'++read eoi\n')
         # pull from tcp
-        return TCPInterface.read(self)
+        data = TCPInterface.read(self)
+        if self.eot is not None and data.endswith(self.eot):
+            data = data[:-len(self.eot)]
+            if self.trim: data = data.strip()
+        return data
+    
+    def _read_bridge(self):
+        """Read a response from the Prologix itself, which is terminated by '\n' regardless of the "eot" setting"""
+        term = self.term
+        self.term = b'\n'
+        try:    return TCPInterface.read(self)
+        finally: self.term = term
+    
+    def read_until_end(self,end=None,idle=None):
+        """Reads a response of unknown length, see TCPInterface.read_until_end(). When "eot" is configured, the response ends at the "eot" character rather than '\n' (without waiting for the device to stop sending)"""
+        if self.pending_poll: self._check_poll()
+        return TCPInterface.read_until_end(self,end,idle)
+    
+    def read_into(self,buf):
+        """Fills the writable buffer "buf" with exactly len(buf) bytes from the device, see TCPInterface.read_into()"""
+        if self.pending_poll: self._check_poll()
+        return TCPInterface.read_into(self,buf)
+    
+    def read_chunks(self):
+        """Generator yielding a response from the device in pieces as they are received, see TCPInterface.read_chunks()"""
+        if self.pending_poll: self._check_poll()
+        if not self.auto: self.write(b'++read eoi\n')
+        for piece in TCPInterface.read_chunks(self):
+            yield piece
+    
+    def write_parts(self,parts):
+        """Sends the buffers in "parts" to the device as binary data, see TCPInterface.write_parts(). Characters with special meaning to the Prologix are escaped, which requires a copy of the data."""
+        return TCPInterface.write_parts(self,[_escape(p) for p in parts])
+    
+    def flush(self,timeout=0):
+        """Removes any pending data to be received, and returns the number of bytes flushed"""
+        if self.pending_poll: self._check_poll()
+        return TCPInterface.flush(self,timeout)
+    
+    def _check_poll(self):
+        """Read the response to a serial poll issued previously, raising ConnectionError if the device didn't respond"""
+        self.pending_poll = False
+        try:    return int(self._read_bridge())
+        except Exception as e:
+            _bridge_cache.pop((self.host,self.port),None)
+            raise ConnectionError(self,e,'Device did not respond to poll')
     
     def clear(self):            self.write(b'++clr\n')
     def lock(self,locked=True): self.write(b'++llo\n' if locked else b'++loc\n')
@@ -73,3 +157,137 @@ class PrologixInterface(TCPInterface):
     def poll(self):             self.write(b'++spoll\n'); return int(self.read(True))
     def srq(self):              self.write(b'++seq\n'); return int(self.read(True))
 
+
+import threading
+class PrologixBus(TCPInterface):
+    _protocol = 'Prologix'
+    def __init__(self, host, port=1234, timeout=1):
+        """
+        Connect to the Prologix Ethernet<->GPIB bridge at (host,port), to communicate with several devices on its GPIB bus through the one connection.
+        Use device() to obtain an interface to the device at a particular GPIB address.
+        
+        Only the settings which differ from the bridge's current state are sent when switching between devices, so switching is cheap.
+        Access to the bridge is serialised with the re-entrant lock "mutex", which can also be held for a whole transaction (e.g. "with bus.mutex:").
+        """
+        # connect to prologix unit (prologix itself requires '\n' eom termination)
+        TCPInterface.__init__(self,host,port,timeout,eom=b'\n')
+        self.timeout = timeout
+        self.mutex = threading.RLock()
+        # make sure it's what we expect
+        self.write(b'++ver\n')
+        if not self.read().startswith(b'Prologix GPIB'):
+            raise ConnectionError(self,None,'Not a Prologix device')
+        # the last value sent for each setting, keyed by command name (e.g. b'++addr')
+        self.state = {}
+        self.active = None
+        # the bus changes the bridge's settings, so a PrologixInterface can't rely on those it cached
+        _bridge_cache.pop((self.host,port),None)
+    
+    def __del__(self):
+        # clean up if possible
+        try:    self.close()
+        except: pass
+    
+    def device(self, gpib, timeout=None, auto=True, assert_eoi=True, eos=None, poll=True):
+        """Return an interface to the device at the specified GPIB address on this bus. Keyword arguments are per PrologixInterface, with the timeout defaulting to that of the bus."""
+        return PrologixAddress(self,gpib,self.timeout if timeout is None else timeout,auto,assert_eoi,eos,poll)
+    
+    def select(self, handle):
+        """Make "handle" the active device, sending (as a single message) only those settings which have changed"""
+        if self.active is handle:
+            return
+        cmds = [cmd for key,cmd in handle.settings if self.state.get(key) != cmd]
+        if len(cmds):
+            TCPInterface.write(self,b''.join(cmds))
+            self.state.update(handle.settings)
+            _bridge_cache.pop((self.host,self.port),None)
+        self.active = handle
+
+
+class PrologixAddress:
+    _protocol = 'Prologix'
+    def __init__(self, bus, gpib, timeout=1, auto=True, assert_eoi=True, eos=None, poll=True):
+        """
+        Interface to the device at the specified GPIB address, communicating through a shared PrologixBus. Created by PrologixBus.device().
+        Keyword arguments are per PrologixInterface.
+        """
+        self.bus = bus
+        self.gpib = gpib
+        self.auto = auto
+        self.mutex = bus.mutex
+        self.settings = [(cmd.split()[0],cmd) for cmd in _setup_commands(gpib,timeout,auto,assert_eoi,eos)]
+        # can we serial poll the device?
+        if poll:
+            try:    self.poll()
+            except: raise ConnectionError(self,None,'Device did not respond to poll')
+    
+    def __str__(self):
+        return '%s device at %s:%i, GPIB address %i'%(self._protocol,self.bus.host,self.bus.port,self.gpib)
+    
+    def write(self,msg):
+        """Sends the "msg" string to the device, see TCPInterface.write()"""
+        with self.mutex:
+            self.bus.select(self)
+            return TCPInterface.write(self.bus,msg)
+    
+    def write_parts(self,parts):
+        """Sends the buffers in "parts" to the device as binary data, see PrologixInterface.write_parts()"""
+        with self.mutex:
+            self.bus.select(self)
+            return TCPInterface.write_parts(self.bus,[_escape(p) for p in parts])
+    
+    def read(self,immediate=False):
+        """Read data from the device, see PrologixInterface.read()"""
+        with self.mutex:
+            self.bus.select(self)
+            # if we're not in auto mode, need to tell prologix to read
+            if not immediate and not self.auto: TCPInterface.write(self.bus,b'++read eoi\n')
+            return TCPInterface.read(self.bus)
+    
+    def read_raw(self,size):
+        """Reads exactly "size" bytes from the device"""
+        with self.mutex:
+            return self.bus.read_raw(size)
+    
+    def read_chunks(self):
+        """Generator yielding a response from the device in pieces as they are received, see TCPInterface.read_chunks()"""
+        with self.mutex:
+            self.bus.select(self)
+            if not self.auto: TCPInterface.write(self.bus,b'++read eoi\n')
+            for piece in TCPInterface.read_chunks(self.bus):
+                yield piece
+    
+    def read_until_end(self,end=None,idle=None):
+        """Reads a response of unknown length from the device, see TCPInterface.read_until_end()"""
+        with self.mutex:
+            return self.bus.read_until_end(end,idle)
+    
+    def read_end(self):
+        """Consume the terminator ending a response read as raw data, see TCPInterface.read_end()"""
+        with self.mutex:
+            return self.bus.read_end()
+    
+    def read_into(self,buf):
+        """Fills the writable buffer "buf" with exactly len(buf) bytes from the device"""
+        with self.mutex:
+            return self.bus.read_into(buf)
+    
+    def has_reply(self,timeout=0):
+        """Checks whether a reply is waiting to be read"""
+        return self.bus.has_reply(timeout)
+    
+    def flush(self,timeout=0):
+        """Removes any pending data to be received, and returns the number of bytes flushed"""
+        with self.mutex:
+            return self.bus.flush(timeout)
+    
+    def clear(self):            self.write(b'++clr\n')
+    def lock(self,locked=True): self.write(b'++llo\n' if locked else b'++loc\n')
+    def local(self):            self.write(b'++loc\n')
+    def reset(self):            self.write(b'++rst\n')
+    def poll(self):
+        with self.mutex:
+            self.write(b'++spoll\n'); return int(self.read(True))
+    def srq(self):
+        with self.mutex:
+            self.write(b'++seq\n'); return int(self.read(True))
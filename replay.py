@@ -0,0 +1,248 @@
+"""
+TELEPYTHIC -- a python interface to test equipment
+Copyright 2014-2020 by Martijn Jasperse
+https://github.com/mjasperse/telepythic
+
+Recording of communication sessions with a device, and replaying them without the device attached (e.g. for offline benchmarking).
+
+A session file starts with the MAGIC string and a flags byte, followed by one record per event:
+    kind   - one byte, see WRITE/READ/TEXT/RAW/FLUSH
+    time   - seconds since the start of the session (little-endian float64)
+    length - size of the following data (little-endian uint32)
+    data   - the data written or read
+Interfaces such as pyvisa instruments exchange str rather than bytes, which is recorded UTF-8 encoded (with responses as TEXT events, so that they are played back as str).
+"""
+import struct, time
+
+MAGIC = b'TPYSESS1'
+WRITE, READ, TEXT, RAW, FLUSH = b'W', b'R', b'T', b'B', b'F'
+FLAG_BSTREAM = 1
+_record = struct.Struct('<cdI')
+
+def read_session(filename):
+    """Load a session file, returning a tuple (flags, events) where events is a list of tuples (kind, time, data)"""
+    with open(filename,'rb') as f:
+        head = f.read(len(MAGIC)+1)
+        if head[:len(MAGIC)] != MAGIC:
+            raise IOError('Not a telepythic session file')
+        flags = bytearray(head)[-1]
+        events = []
+        while 1:
+            rec = f.read(_record.size)
+            if len(rec) < _record.size:
+                break
+            kind, t, n = _record.unpack(rec)
+            events.append((kind, t, f.read(n)))
+    return flags, events
+
+
+class RecordingInterface:
+    def __init__(self, interface, filename):
+        """
+        Wrap "interface" (e.g. a TCPInterface, PrologixInterface or pyvisa instrument) so that everything written to and read from it is recorded to the session file "filename".
+        The session can be played back with ReplayInterface.
+        """
+        self.ifc = interface
+        self.start = time.time()
+        self.file = open(filename,'wb')
+        bstream = getattr(interface,'bstream',True) and not hasattr(interface,'visalib')
+        self.file.write(MAGIC + bytearray([FLAG_BSTREAM if bstream else 0]))
+        self.bstream = bstream
+        # only provide the optional functions the interface has
+        if hasattr(interface,'read_into'):
+            self.read_into = self._read_into
+        if hasattr(interface,'flush'):
+            self.flush = self._flush
+        if hasattr(interface,'write_parts'):
+            self.write_parts = self._write_parts
+        if hasattr(interface,'read_until_end'):
+            self.read_until_end = self._read_until_end
+        if hasattr(interface,'read_chunks'):
+            self.read_chunks = self._read_chunks
+        if hasattr(interface,'read_end'):
+            self.read_end = self._read_end
+    
+    def __getattr__(self, name):
+        # only called for attributes not found on this instance, so pass on to the interface
+        if name == 'ifc':
+            raise AttributeError(name)
+        return getattr(self.ifc, name)
+    
+    def __str__(self):
+        return 'Recording of ' + str(self.ifc)
+    
+    def _log(self, kind, data):
+        self.file.write(_record.pack(kind, time.time()-self.start, len(data)))
+        self.file.write(data)
+    
+    def write(self, msg):
+        """Write "msg" to the interface, recording it"""
+        self._log(WRITE, msg.encode() if hasattr(msg,'encode') else msg)
+        return self.ifc.write(msg)
+    
+    def _write_parts(self, parts):
+        """Write the buffers in "parts" to the interface, recording them as a single write"""
+        self._log(WRITE, b''.join([memoryview(p).cast('B') for p in parts]))
+        return self.ifc.write_parts(parts)
+    
+    def read(self, *args):
+        """Read a response from the interface, recording it"""
+        data = self.ifc.read(*args)
+        if hasattr(data,'encode'):
+            self._log(TEXT, data.encode())
+        else:
+            self._log(READ, data)
+        return data
+    
+    def read_raw(self, size):
+        """Read raw data from the interface, recording it"""
+        data = self.ifc.read_raw(size)
+        self._log(RAW, data)
+        return data
+    
+    def _read_into(self, buf):
+        """Fill "buf" from the interface, recording the data"""
+        n = self.ifc.read_into(buf)
+        self._log(RAW, memoryview(buf).cast('B').tobytes())
+        return n
+    
+    def _read_until_end(self, *args):
+        """Read a response of unknown length from the interface, recording it"""
+        data = self.ifc.read_until_end(*args)
+        self._log(RAW, bytes(data))
+        return data
+    
+    def _read_end(self):
+        """Consume the terminator following raw data from the interface, recording what was consumed (even if nothing)"""
+        data = self.ifc.read_end()
+        self._log(RAW, data)
+        return data
+    
+    def _read_chunks(self):
+        """Read a response from the interface in pieces, recording it as a single response"""
+        pieces = []
+        for piece in self.ifc.read_chunks():
+            pieces.append(piece)
+            yield piece
+        self._log(READ, b''.join(pieces))
+    
+    def _flush(self, *args):
+        """Flush the interface, recording the number of bytes flushed"""
+        n = self.ifc.flush(*args)
+        self._log(FLUSH, str(n).encode())
+        return n
+    
+    def close(self):
+        """Close the session file and the underlying interface"""
+        self.file.close()
+        if hasattr(self.ifc,'close'):
+            self.ifc.close()
+
+
+class ReplayInterface:
+    _protocol = 'Replay'
+    def __init__(self, filename, realtime=False, strict=True):
+        """
+        An interface which plays back a session recorded with RecordingInterface, serving the recorded responses to the same sequence of writes and reads.
+    
+        Keyword arguments:
+        realtime -- reproduce the recorded delay before each response, rather than responding immediately (default: False)
+        strict   -- raise an error if a write does not match the one recorded (default: True)
+        """
+        self.filename = filename
+        flags, self.events = read_session(filename)
+        self.bstream = bool(flags & FLAG_BSTREAM)
+        self.realtime = realtime
+        self.strict = strict
+        self.rewind()
+    
+    def __str__(self):
+        return '%s of %s'%(self._protocol,self.filename)
+    
+    def rewind(self):
+        """Restart playback from the beginning of the session"""
+        self.pos = 0
+        self.pending = memoryview(b'')
+        self.last = None
+    
+    def _next(self, kind):
+        """Return the data of the next event, which must be of the specified kind"""
+        if self.pos >= len(self.events):
+            raise IOError('End of recorded session')
+        k, t, data = self.events[self.pos]
+        if k != kind:
+            raise IOError('Recorded session expected %r event, not %r'%(k,kind))
+        self.pos += 1
+        if self.realtime and self.last is not None:
+            # wait until the same time has passed since the previous event as when recorded
+            delay = (t - self.last[0]) - (time.time() - self.last[1])
+            if delay > 0:
+                time.sleep(delay)
+        self.last = (t, time.time())
+        return data
+    
+    def write(self, msg):
+        """Check "msg" matches the next recorded write"""
+        data = self._next(WRITE)
+        if hasattr(msg,'encode'):
+            msg = msg.encode()
+        if self.strict and data != msg:
+            raise IOError('Recorded session expected write %r, not %r'%(data,msg))
+        return len(msg)
+    
+    def read(self, *args):
+        """Return the next recorded response, as str if it was recorded as str"""
+        if self.pos < len(self.events) and self.events[self.pos][0] == TEXT:
+            return self._next(TEXT).decode()
+        return self._next(READ)
+    
+    def read_raw(self, size):
+        """Return the next "size" bytes of recorded raw data, or if "size" is None the next recorded raw response"""
+        if size is None:
+            return self._next(RAW)
+        data = bytearray(size)
+        self.read_into(data)
+        return bytes(data)
+    
+    def read_into(self, buf):
+        """Fill "buf" with recorded raw data"""
+        view = memoryview(buf).cast('B')
+        n = 0
+        while n < len(view):
+            if not len(self.pending):
+                self.pending = memoryview(self._next(RAW))
+            k = min(len(self.pending), len(view)-n)
+            view[n:n+k] = self.pending[:k]
+            self.pending = self.pending[k:]
+            n += k
+        return n
+    
+    def read_until_end(self, end=None):
+        """Return the remainder of the current recorded raw response"""
+        if len(self.pending):
+            data = bytearray(self.pending)
+            self.pending = memoryview(b'')
+            return data
+        return bytearray(self._next(RAW))
+    
+    def read_end(self):
+        """Return the recorded terminator following raw data"""
+        if len(self.pending):
+            data = self.pending.tobytes()
+            self.pending = memoryview(b'')
+            return data
+        return self._next(RAW)
+    
+    def has_reply(self, timeout=0):
+        """Whether the next recorded event is a response"""
+        return len(self.pending) > 0 or (self.pos < len(self.events) and self.events[self.pos][0] in (READ,TEXT,RAW))
+    
+    def flush(self, *args):
+        """Replay a recorded flush, returning the number of bytes recorded as flushed"""
+        self.pending = memoryview(b'')
+        if self.pos < len(self.events) and self.events[self.pos][0] == FLUSH:
+            return int(self._next(FLUSH))
+        return 0
+    
+    def close(self):
+        pass
@@ -0,0 +1,100 @@
+"""
+TELEPYTHIC -- a python interface to test equipment
+Copyright 2014-2020 by Martijn Jasperse
+https://github.com/mjasperse/telepythic
+
+Declarative parsing of replies, see TelepythicDevice.schemas.
+
+A reply type is a function which converts the (stripped) reply to a value, e.g. int, float, string or enum.
+A Schema describes a compound reply of ';'-separated fields, e.g. the response of a Tektronix scope to WFMP?:
+    Schema({'NR_P': int, 'XIN': float, 'BYT_O': enum})
+"""
+import re
+
+def string(x):
+    """A string reply, returned without quotes"""
+    if x[:1] == b'"':
+        return x[1:x.rfind(b'"')]
+    return x
+
+def enum(x):
+    """A reply which is a token (e.g. b'MSB' or b'ON'), returned as is"""
+    return x
+
+_int = re.compile(b'[+-]?[0-9]+$')
+_float = re.compile(b'[+-]?(([0-9]+[.]?[0-9]*|[.][0-9]+)([eE][+-]?[0-9]+)?|(?i:nan|inf|infinity))$')
+
+def infer(x):
+    """Return the reply type of the stripped reply "x" (int, float, string or enum), or None if it is empty"""
+    if not len(x):          return None
+    if x[:1] == b'"':       return string
+    if _int.match(x):       return int
+    if _float.match(x):     return float
+    return enum
+
+def convert(x, kind):
+    """Convert the stripped reply "x" with the reply type "kind" (as returned by infer())"""
+    if kind is None:
+        return None
+    return kind(x)
+
+# a field of a compound reply, which may contain quoted strings
+_field = re.compile(b'(?:"[^"]*"|[^;"])+')
+
+
+class Schema:
+    def __init__(self, fields, names=True):
+        """
+        A compiled parser for compound replies, whose fields are separated by ';'. "fields" maps the field names to their reply types, and parse() returns a dict of the values.
+        If "names" is True, each field of the reply starts with its name (e.g. b'NR_P 500;XIN 1.0E-6', as with HEAD 1 on many instruments), and the types of fields not in "fields" are inferred (see _infer_cached).
+        Otherwise the reply is only the values, in the order given by "fields" (which should then be a list of (name,type) tuples).
+        """
+        self.names = names
+        if names:
+            self.fields = dict(fields)
+            # types inferred for fields not in the schema
+            self.inferred = {}
+        else:
+            self.order = list(fields)
+    
+    def __call__(self, x):
+        return self.parse(x)
+    
+    def parse(self, reply):
+        """Parse the compound reply into a dict of field values"""
+        fields = _field.findall(reply)
+        if not self.names:
+            if len(fields) != len(self.order):
+                raise ValueError('Expected %i fields, got %i'%(len(self.order),len(fields)))
+            return {name: convert(x.strip(), kind) for (name,kind),x in zip(self.order,fields)}
+        vals = {}
+        for x in fields:
+            name, _, x = x.strip().partition(b' ')
+            name = name.decode()
+            x = x.strip()
+            kind = self.fields.get(name)
+            if kind is not None:
+                vals[name] = kind(x)
+            else:
+                vals[name] = _infer_cached(self.inferred, name, x)
+        return vals
+
+
+def _infer_cached(cache, key, x):
+    """
+    Convert the stripped reply "x" with the type cached for "key", inferring (and caching) the type if there is none or it doesn't fit.
+    Only a numeric type is trusted while replies still convert (with integer replies still returned as int), since any reply fits a string or enum.
+    """
+    kind = cache.get(key)
+    if kind is int or kind is float:
+        try:
+            if kind is int or _int.match(x):
+                return int(x)
+            return float(x)
+        except ValueError:
+            pass
+    kind = infer(x)
+    if kind is not None:
+        cache[key] = kind
+    return convert(x, kind)
+
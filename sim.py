@@ -0,0 +1,190 @@
+"""
+TELEPYTHIC -- a python interface to test equipment
+Copyright 2014-2020 by Martijn Jasperse
+https://github.com/mjasperse/telepythic
+
+In-process device simulators, for testing and benchmarking the interfaces without real equipment.
+Each simulator listens on a local TCP port (see the "port" attribute) from a background thread:
+
+    SCPISimulator     -- a plain TCP device, terminating responses with "eom"
+    TelnetSimulator   -- a Telnet-style device, which emits a prompt when ready for input
+    PrologixSimulator -- a Prologix Ethernet<->GPIB bridge, with a simulated device at each GPIB address
+
+The devices understand the following commands:
+    *IDN?           -- identification string
+    BLOCK? n        -- an IEEE-488.2 definite-length block of n bytes
+    INDEF? n        -- an IEEE-488.2 indefinite-length block of n bytes
+    ASCII? n        -- a comma-separated list of n integers
+    ECHO text       -- responds with "text"
+plus any others given in the "responses" dict, mapping a command to either a response string or a function which returns one (given the command arguments).
+
+Responses are optionally split into "fragment" sized pieces, sent "delay" seconds apart.
+"""
+import socket, threading, time
+
+IDN = b'TELEPYTHIC,SIMULATOR,0,1.0'
+
+def block(data):
+    """Format "data" as an IEEE-488.2 definite-length block"""
+    n = b'%i'%len(data)
+    return b'#%i'%len(n) + n + data
+
+def pattern(size):
+    """Return "size" bytes of a repeating test pattern"""
+    return (bytes(bytearray(range(256))) * (size//256 + 1))[:size]
+
+
+class SCPISimulator:
+    def __init__(self, responses=None, eom=b'\n', fragment=None, delay=0):
+        """Start a simulated TCP device on a free local port. See the module documentation for the keyword arguments."""
+        self.responses = dict(responses or {})
+        self.eom = eom
+        self.fragment = fragment
+        self.delay = delay
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(5)
+        self.host, self.port = self.server.getsockname()
+        self.thread = threading.Thread(target=self._serve)
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        self.close()
+    
+    def close(self):
+        """Stop accepting connections"""
+        try:    self.server.close()
+        except: pass
+    
+    def respond(self, cmd):
+        """Return the response to the command "cmd" (without terminator), or None if it has no response"""
+        name, _, args = cmd.partition(b' ')
+        if name in self.responses:
+            resp = self.responses[name]
+            return resp(args) if callable(resp) else resp
+        if name == b'*IDN?':    return IDN
+        if name == b'BLOCK?':   return block(pattern(int(args)))
+        if name == b'INDEF?':   return b'#0' + pattern(int(args))
+        if name == b'ASCII?':   return b','.join([b'%i'%(i%1000) for i in range(int(args))])
+        if name == b'ECHO':     return args
+        return None
+    
+    def send(self, conn, data):
+        """Send "data" on the connection, fragmented and delayed as configured"""
+        if self.delay:
+            time.sleep(self.delay)
+        if not self.fragment:
+            conn.sendall(data)
+            return
+        view = memoryview(data)
+        for i in range(0, len(view), self.fragment):
+            if i and self.delay:
+                time.sleep(self.delay)
+            conn.sendall(view[i:i+self.fragment])
+    
+    def connected(self, conn):
+        """Called when a client connects"""
+        pass
+    
+    def handle(self, conn, cmd):
+        """Process a single command from the client"""
+        resp = self.respond(cmd)
+        if resp is not None:
+            self.send(conn, resp + self.eom)
+    
+    def _serve(self):
+        while 1:
+            try:
+                conn = self.server.accept()[0]
+            except socket.error:
+                return
+            t = threading.Thread(target=self._session, args=(conn,))
+            t.daemon = True
+            t.start()
+    
+    def _session(self, conn):
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.connected(conn)
+        buf = b''
+        try:
+            while 1:
+                data = conn.recv(65536)
+                if not data:
+                    break
+                buf += data
+                while b'\n' in buf:
+                    line, buf = buf.split(b'\n', 1)
+                    self.handle(conn, line.strip())
+        except socket.error:
+            pass
+        finally:
+            conn.close()
+
+
+class TelnetSimulator(SCPISimulator):
+    def __init__(self, responses=None, eom=b'\r\n', prompt=b'> ', fragment=None, delay=0):
+        """Start a simulated Telnet-style device, which sends "prompt" on connection and after processing each command"""
+        self.prompt = prompt
+        SCPISimulator.__init__(self, responses, eom, fragment, delay)
+    
+    def connected(self, conn):
+        conn.sendall(b'Welcome' + self.eom + self.prompt)
+    
+    def handle(self, conn, cmd):
+        resp = self.respond(cmd)
+        if resp is None:
+            self.send(conn, self.prompt)
+        else:
+            self.send(conn, resp + self.eom + self.prompt)
+
+
+class PrologixSimulator(SCPISimulator):
+    def __init__(self, devices=None, fragment=None, delay=0):
+        """
+        Start a simulated Prologix bridge. "devices" is a dict mapping GPIB addresses to SCPISimulator-like objects whose respond() function is used (default: a simulated device at every address).
+        The simulator is not itself listening for device connections, so the devices needn't be started.
+        """
+        self.devices = devices or {}
+        self.addr = 0
+        self.auto = 1
+        self.pending = None
+        self.eot = False
+        self.eot_char = b''
+        SCPISimulator.__init__(self, None, b'\n', fragment, delay)
+    
+    def device(self):
+        """Return the responder for the current GPIB address"""
+        return self.devices.get(self.addr, self)
+    
+    def handle(self, conn, cmd):
+        if not cmd.startswith(b'++'):
+            resp = self.device().respond(cmd)
+            if resp is not None:
+                resp = resp + b'\n' + (self.eot_char if self.eot else b'')
+                if self.auto:
+                    self.send(conn, resp)
+                else:
+                    self.pending = resp
+            return
+        name, _, args = cmd.partition(b' ')
+        if name == b'++ver':
+            conn.sendall(b'Prologix GPIB-ETHERNET Controller version 01.06.06.00\r\n')
+        elif name == b'++addr' and args:
+            self.addr = int(args)
+        elif name == b'++auto' and args:
+            self.auto = int(args)
+        elif name == b'++eot_char' and args:
+            self.eot_char = bytes(bytearray([int(args)]))
+        elif name == b'++eot_enable' and args:
+            self.eot = bool(int(args))
+        elif name == b'++spoll':
+            conn.sendall(b'0\r\n')
+        elif name == b'++read' and self.pending is not None:
+            self.send(conn, self.pending)
+            self.pending = None
+        # all other settings are accepted and ignored
@@ -6,9 +6,24 @@ https://github.com/mjasperse/telepythic
 import socket, select
 from .telepythic import ConnectionError
 
+def _resolve_host(host):
+    """Convert a host specified as an integer (either a 32-bit IP, or the final octet of the local IP) to an address string"""
+    if isinstance(host,int):
+        if host > 255:
+            # assume it's an IP specified in integer format
+            import struct
+            host = socket.inet_ntoa(struct.pack("!I",host))
+        else:
+            # assume it's the final octet of an IP
+            # get the local (default) ip address -- probably breaks on multiple interface machines
+            myaddr = socket.gethostbyname_ex('')[2][0]
+            # replace the last octet
+            host = myaddr.rsplit('.',1)[0] + '.' + str(host)
+    return host
+
 class TCPInterface:
     _protocol = 'TCP'
-    def __init__(self, host, port, timeout=1, eom=b'\r\n', trim=True, buffer=1024):
+    def __init__(self, host, port, timeout=1, eom=b'\r\n', trim=True, buffer=65536, term=None, maxsize=None):
         """
         Connect to the specified TCP device
         
@@ -18,19 +33,13 @@ class TCPInterface:
         timeout -- Communication timeout, in seconds (default: 1)
         eom     -- "End-Of-Message" string, appended to outgoing messages if not present (default: \\r\\n)
         trim    -- Whether to trip whitespace from responses (default: True)
-        buffer  -- TCP receive buffer chunk size (default: 1024)
+        buffer  -- TCP receive buffer chunk size (default: 65536)
+        term    -- Terminator which ends each response, see read() (default: last character of eom)
+        maxsize -- Maximum size of a response in bytes, or None for unlimited (default: None)
+        
+        If the "stats" attribute is set to a metrics.IOCounters instance, the bytes sent and received are counted (see TelepythicDevice.enable_metrics).
         """
-        if isinstance(host,int):
-            if host > 255:
-                # assume it's an IP specified in integer format
-                import struct
-                host = socket.inet_ntoa(struct.pack("!I",host))
-            else:
-                # assume it's the final octet of an IP
-                # get the local (default) ip address -- probably breaks on multiple interface machines
-                myaddr = socket.gethostbyname_ex('')[2][0]
-                # replace the last octet
-                host = myaddr.rsplit('.',1)[0] + '.' + str(host)
+        host = _resolve_host(host)
         # create a TCP socket
         self.host = host
         self.port = port
@@ -44,6 +53,13 @@ class TCPInterface:
         self.eom = eom
         self.trim = trim
         self.buffer = buffer
+        if term is None and eom:
+            term = eom[-1:]
+        self.term = term
+        self.maxsize = maxsize
+        # received data which has not yet been consumed
+        self.rbuf = bytearray()
+        self.stats = None
     
     def __str__(self):
         return '%s device at %s:%i'%(self._protocol,self.host,self.port)
@@ -55,44 +71,235 @@ class TCPInterface:
     
     def has_reply(self,timeout=0):
         """Checks whether a reply is waiting to be read"""
+        if len(self.rbuf):
+            return True
         # is something waiting on the socket to be read?
         socklist = select.select([self.sock],[],[],timeout)
         return len(socklist[0])>0
         
     def flush(self,timeout=0):
         """Removes any pending data to be received from the socket, and returns the number of bytes flushed"""
+        # discard anything already buffered
+        n = len(self.rbuf)
+        del self.rbuf[:]
         # read with zero timeout until there's nothing remaining to read
-        n = 0
         while self.has_reply(timeout):
             n += len(self.sock.recv(self.buffer))
         return n
         
     def read(self):
-        """Read data from the socket, trim the whitespace if specified in the constructor"""
-        # pull all the data off the line
-        data = self.sock.recv(self.buffer)
-        while self.has_reply(timeout=0):
-            data += self.sock.recv(self.buffer)
+        """
+        Read a response from the socket, up to and including the terminator "term" (see constructor), and trim the whitespace if specified in the constructor.
+        Any data received after the terminator is kept for the next read. If the device stops sending before a terminator is received, the partial response is returned.
+        """
+        if self.term is None:
+            # no framing, return whatever is available
+            data = self._read_available()
+        else:
+            end = self._find_term()
+            data = bytes(self.rbuf[:end])
+            del self.rbuf[:end]
         if self.trim:
             return data.strip()
         return data
     
+    def read_chunks(self):
+        """
+        Generator yielding a response in pieces as they are received, up to (but not including) the terminator "term", so that it can be processed while the rest is arriving.
+        As per read(), any data after the terminator is kept for the next read and a partial response is returned if the device stops sending before the terminator.
+        """
+        term = self.term
+        if term is None:
+            # no framing, return whatever is available
+            yield self._read_available()
+            return
+        received = False
+        while 1:
+            if len(self.rbuf):
+                received = True
+                i = self.rbuf.find(term)
+                if i >= 0:
+                    piece = bytes(self.rbuf[:i])
+                    del self.rbuf[:i+len(term)]
+                    yield piece
+                    return
+                # hold back enough to find a terminator split between receives
+                k = len(self.rbuf) - len(term) + 1
+                if k > 0:
+                    piece = bytes(self.rbuf[:k])
+                    del self.rbuf[:k]
+                    yield piece
+            try:
+                self._recv()
+            except socket.timeout:
+                if not received:
+                    raise
+                # unterminated response, return what we have
+                piece = bytes(self.rbuf)
+                del self.rbuf[:]
+                yield piece
+                return
+    
+    def _recv(self):
+        """Receive a single chunk from the socket into the read buffer, and return the number of bytes received"""
+        data = self.sock.recv(self.buffer)
+        if not data:
+            raise socket.error('Connection closed by remote host')
+        if self.stats is not None:
+            self.stats.received(len(data))
+        self.rbuf += data
+        return len(data)
+    
+    def _read_available(self):
+        """Return everything buffered, or if there is nothing buffered the data from a single receive"""
+        if not len(self.rbuf):
+            self._recv()
+        data = bytes(self.rbuf)
+        del self.rbuf[:]
+        return data
+    
+    def _find_term(self):
+        """Receive until the terminator is in the read buffer, and return the index just past it"""
+        term = self.term
+        start = 0
+        while 1:
+            # only search the data that has not already been searched
+            i = self.rbuf.find(term, start)
+            if i >= 0:
+                return i + len(term)
+            if self.maxsize is not None and len(self.rbuf) > self.maxsize:
+                del self.rbuf[:]
+                raise IOError('Response exceeds maximum size of %i bytes'%self.maxsize)
+            start = max(0, len(self.rbuf) - len(term) + 1)
+            try:
+                self._recv()
+            except socket.timeout:
+                if not len(self.rbuf):
+                    raise
+                # unterminated response, return what we have
+                return len(self.rbuf)
+    
     def read_raw(self,size):
         """Reads exactly "size" bytes from the socket"""
-        # read exactly size bytes from the input
-        data = self.sock.recv(size)
-        while size > len(data):
-            data += self.sock.recv(size-len(data))
+        # read exactly size bytes from the input into a single preallocated buffer
+        data = bytearray(size)
+        self.read_into(data)
+        return bytes(data)
+    
+    def read_into(self,buf):
+        """Fills the writable buffer "buf" (e.g. a bytearray or numpy array) with exactly len(buf) bytes from the socket, without intermediate copies. Returns the number of bytes read"""
+        view = memoryview(buf).cast('B')
+        size = len(view)
+        # consume buffered data first
+        n = min(size, len(self.rbuf))
+        if n:
+            view[:n] = self.rbuf[:n]
+            del self.rbuf[:n]
+        while n < size:
+            k = self.sock.recv_into(view[n:])
+            if k == 0:
+                raise socket.error('Connection closed by remote host')
+            if self.stats is not None:
+                self.stats.received(k)
+            n += k
+        return n
+    
+    def read_end(self):
+        """
+        Consume the terminator "term" ending a response which was read as raw data (e.g. after a binary block), along with any line break before it, and return the bytes consumed.
+        Anything else (e.g. a ';' separating further responses) is left to be read. Returns nothing consumed if the device sends nothing more within the timeout.
+        """
+        if self.term is None:
+            return b''
+        n = 0
+        try:
+            while 1:
+                if len(self.rbuf) <= n:
+                    self._recv()
+                if self.rbuf[n:n+len(self.term)] == self.term:
+                    n += len(self.term)
+                    break
+                if self.rbuf[n:n+1] not in (b'\r',b'\n'):
+                    n = 0
+                    break
+                n += 1
+        except socket.timeout:
+            n = 0
+        data = bytes(self.rbuf[:n])
+        del self.rbuf[:n]
+        return data
+    
+    def read_until_end(self,end=None,idle=None):
+        """
+        Reads a response of unknown length (e.g. an indefinite-length GPIB block), until the data received ends with "end" and then nothing more is received for "idle" seconds.
+        By default "end" is the "eot" attribute if set, which cannot occur in the response and so ends it immediately. Otherwise it is the terminator "term", which binary data can contain, so "idle" defaults to the socket timeout.
+        Returns the response as a single bytearray, with "end" (and the terminator before it, if any) removed.
+        """
+        if end is None:
+            eot = getattr(self,'eot',None)
+            end = eot or self.term
+            if not eot and idle is None:
+                idle = self.sock.gettimeout()
+        while not (self.rbuf.endswith(end) and not (idle and self._waiting(idle))):
+            self._recv()
+        if self.eom and self.eom.endswith(end):
+            # the end marker is part of the line break, e.g. '\n' of '\r\n'
+            return self._take_response(len(self.rbuf)-len(end), [self.eom[:-len(end)]])
+        return self._take_response(len(self.rbuf)-len(end))
+    
+    def _waiting(self,timeout=0):
+        """Checks whether data is waiting on the socket (ignoring the read buffer), waiting up to "timeout" seconds for it to arrive"""
+        return len(select.select([self.sock],[],[],timeout)[0]) > 0
+    
+    def _take_response(self,end,breaks=None):
+        """Remove and return the read buffer as the response, truncated at index "end" and without the first of "breaks" (default: eom or term) that it ends with"""
+        data = self.rbuf
+        self.rbuf = bytearray()
+        del data[end:]
+        for term in breaks or (self.eom, self.term):
+            if term and data.endswith(term):
+                del data[len(data)-len(term):]
+                break
         return data
     
     def write(self,msg):
         """Sends the "msg" string to the socket, appending the End-Of-Message (eom) string if not present. Returns the number of bytes sent"""
-        # append eom if not already there
+        # append eom if not already there (without copying msg)
         if self.eom is not None and not msg.endswith(self.eom):
-            msg += self.eom
-        self.sock.send(msg)
-        # return bytes sent
-        return len(msg)
+            return self._sendv([msg,self.eom])
+        return self._sendv([msg])
+    
+    def write_parts(self,parts):
+        """
+        Sends the buffers in "parts" (e.g. byte strings or C-contiguous numpy arrays) consecutively, followed by the End-Of-Message (eom) string. Returns the number of bytes sent.
+        The buffers are sent with scatter/gather I/O where available, rather than being concatenated into a single message.
+        """
+        if self.eom is not None:
+            parts = list(parts) + [self.eom]
+        return self._sendv(parts)
+    
+    def _sendv(self,parts):
+        """Send all of the buffers in "parts", looping until every byte has been sent. Returns the number of bytes sent"""
+        views = [memoryview(p).cast('B') for p in parts]
+        views = [v for v in views if len(v)]
+        total = sum([len(v) for v in views])
+        while len(views):
+            if hasattr(self.sock,'sendmsg'):
+                n = self.sock.sendmsg(views)
+            else:
+                # no scatter/gather on this platform
+                n = self.sock.send(views[0])
+            # drop whatever was sent from the front of the queue
+            while n:
+                k = min(n,len(views[0]))
+                n -= k
+                if k == len(views[0]):
+                    views.pop(0)
+                else:
+                    views[0] = views[0][k:]
+        if self.stats is not None:
+            self.stats.sent(total)
+        return total
     
 import re
 class TelnetInterface(TCPInterface):
@@ -104,13 +311,7 @@ class TelnetInterface(TCPInterface):
         Keyword arguments are per TCPInterface
         """
         TCPInterface.__init__(self,host,port,timeout=timeout,eom=eom,trim=False)
-        # compile a regex that looks for any number of prompt strings
-        if hasattr(prompt,'__iter__'):
-            prompt = b'(' + b'|'.join([re.escape(s) for s in prompt]) + b')'
-        else:
-            prompt = re.escape(prompt)
-        self.re_end = re.compile(prompt+b'$')
-        self.re_multi = re.compile(b'([\r\n]*'+prompt+b')+')
+        self._compile_prompt(prompt)
         if initial is not None:
             self.write(initial)
         try:
@@ -122,22 +323,109 @@ class TelnetInterface(TCPInterface):
         except socket.timeout as e:
             raise ConnectionError(self,e,'Connected but no ready prompt, check Telnet is enabled')
 
+    def _compile_prompt(self,prompt):
+        """Compile the regexes that look for the prompt string (or any of a list of prompt strings)"""
+        if isinstance(prompt,bytes):
+            prompt = [prompt]
+        # how far back from new data a prompt (and the line break before it) can start
+        self.overlap = max(len(s) for s in prompt) + 1
+        prompt = b'(' + b'|'.join([re.escape(s) for s in prompt]) + b')'
+        self.re_end = re.compile(prompt+b'$')
+        # a prompt inside the data only ends the response if another prompt follows, since a line of the response may start with the prompt string (e.g. ":" or "?")
+        self.re_line = re.compile(b'[\r\n]'+prompt+b'(?=[\r\n]*'+prompt+b')')
+        self.re_multi = re.compile(b'([\r\n]*'+prompt+b')+')
+    
     def read(self):
-        """Read data from the socket, until the ready-for-input prompt is received. The prompt string is removed from the response."""
-        data = ''
-        # read until we get something other than a prompt statement
+        """
+        Read data from the socket, until the ready-for-input prompt is received. The prompt string is removed from the response.
+        The response ends at a prompt which is the last data received, or at a prompt starting a new line which is followed by another prompt. Any data after the prompt is kept for the next read.
+        """
+        data = bytearray()
+        scanned = 0     # length of data already searched for a prompt
         while 1:
-            data += TCPInterface.read(self)
-            # starts any prompt statements?
+            data += self._read_available()
+            if self._end_of_reply(data, scanned):
+                break
+            scanned = len(data)
+        return bytes(data).rstrip()
+    
+    def _end_of_reply(self,data,scanned):
+        """
+        Check whether the bytearray "data" holds a complete response, of which the first "scanned" bytes have been checked previously.
+        If so, the prompt and anything after it are removed from "data" (the latter is kept in the read buffer) and True is returned.
+        """
+        if not scanned:
+            # strip any leading prompt statements
             M = self.re_multi.match(data)
-            if M is not None: data = data[M.end()+1:]
-            # drop the prompt at the end
-            M = self.re_end.search(data)
             if M is not None:
-                data = data[:M.start()].rstrip()
-                break
-        return data
+                del data[:M.end()]
+                while data[:1] in (b'\r',b'\n'):
+                    del data[:1]
+            if not len(data):
+                return False
+        # only search the new data, plus enough of the old to catch a prompt split between reads
+        M = self.re_line.search(data, max(0, scanned - self.overlap))
+        if M is not None:
+            # keep whatever follows the prompt for the next read
+            self.rbuf[:0] = data[M.end():]
+            del data[M.start():]
+            return True
+        # drop the prompt at the end
+        M = self.re_end.search(data, max(0, len(data) - self.overlap))
+        if M is not None:
+            del data[M.start():]
+            return True
+        return False
         
+    def read_chunks(self):
+        """
+        Generator yielding a response in pieces as they are received, up to (but not including) the ready-for-input prompt, so that it can be processed while the rest is arriving.
+        As per read(), prompts left over from previous commands are skipped, the response ends at the same prompt and anything after the prompt is kept for the next read.
+        """
+        self.skip_prompts()
+        while 1:
+            M = self.re_line.search(self.rbuf)
+            if M is None:
+                M = self.re_end.search(self.rbuf, max(0, len(self.rbuf) - self.overlap))
+            if M is not None:
+                piece = bytes(self.rbuf[:M.start()]).rstrip()
+                del self.rbuf[:M.end()]
+                yield piece
+                return
+            # hold back enough to find a prompt split between receives
+            k = len(self.rbuf) - self.overlap
+            if k > 0:
+                piece = bytes(self.rbuf[:k])
+                del self.rbuf[:k]
+                yield piece
+            self._recv()
+    
+    def skip_prompts(self):
+        """Discard any prompts (and line breaks) left over from previous commands, receiving until the start of the next response"""
+        while 1:
+            M = self.re_multi.match(self.rbuf)
+            if M is not None:
+                del self.rbuf[:M.end()]
+            while self.rbuf[:1] in (b'\r',b'\n'):
+                del self.rbuf[:1]
+            if len(self.rbuf):
+                return
+            self._recv()
+    
+    def read_until_end(self,end=None,idle=None):
+        """
+        Reads a response of unknown length, until the ready-for-input prompt is received (or "end", see TCPInterface.read_until_end()) and then nothing more is received for "idle" seconds (default: the prompt ends the response immediately).
+        As per read(), prompts left over from previous commands are not part of the response.
+        """
+        self.skip_prompts()
+        if end is not None:
+            return TCPInterface.read_until_end(self,end,idle)
+        while 1:
+            M = self.re_end.search(self.rbuf, max(0, len(self.rbuf) - self.overlap))
+            if M is not None and not (idle and self._waiting(idle)):
+                return self._take_response(M.start())
+            self._recv()
+    
     def flush(self,timeout=0.25):
         """Flush any data waiting to be read (default timeout 250ms)"""
         return TCPInterface.flush(self,timeout)
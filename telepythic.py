@@ -4,6 +4,9 @@ Copyright 2014-2020 by Martijn Jasperse
 https://github.com/mjasperse/telepythic
 """
 import numpy as np
+import threading, time
+from .metrics import Metrics, IOCounters, no_measurement, mnemonic
+from . import schema
 
 class TelepythicError(Exception):
     """A simple exception class for use with telepythic, that wraps underlying protocol errors."""
@@ -49,6 +52,18 @@ class TelepythicDevice:
         # do we have an underlying bytestream that can be read in segments? (not supported by VISA)
         # see also read_block()
         self.bstream = getattr(interface,'bstream',True) and not hasattr(interface,'visalib')
+        # lock that makes each transaction atomic, shared by all devices using the same interface
+        self.mutex = _interface_mutex(interface)
+        # I/O statistics, see enable_metrics()
+        self.metrics = None
+        # maximum number of queries to join into a single compound message, see query()
+        self.batch = 1
+        self.query_sep = b';'
+        self.reply_sep = b';'
+        self.batch_failed = False
+        # reply types by command mnemonic, and those inferred from previous replies, see parse_reply()
+        self.schemas = {}
+        self.inferred = {}
     
     def __del__(self):
         """Destructor, attempts to close connection to the device"""
@@ -68,7 +83,7 @@ class TelepythicDevice:
                 raise TelepythicError(self.dev,None,'Expected ID '+repr(expect)+', got '+repr(id))
         return id
     
-    def read_block(self,format=None):
+    def read_block(self,format=None,out=None):
         """Read a GPIB-style block of binary data from the device. If "format" is specified, the data is reinterpreted as a 1D numpy array with the corresponding dtype.
         
         GPIB block data is a binary stream of the form:
@@ -76,9 +91,19 @@ class TelepythicDevice:
             N    - the size of following length string (single ASCII digit)
             M..M - number of bytes in the following data string (N-digits of ASCII)
             X..X - the actual data string (M bytes of binary data)
+        If N is zero the block has indefinite length, and the data continues until the end of the response (NL with EOI). VISA reads to EOI; other interfaces read until an unambiguous end marker (e.g. a Prologix "eot" character or Telnet prompt), or until the terminator is followed by a timeout without further data, see TCPInterface.read_until_end().
+        
+        If "out" is specified, the data is stored there instead of in a newly allocated array, and "out" (or a view of the filled elements) is returned. If "format" is not given, the dtype of "out" is used. "out" may be:
+            - a C-contiguous numpy array (including np.memmap), which the data is written into directly
+            - a filename, in which case a new .npy file is created with np.lib.format.open_memmap and filled
+            - an array-like with slice assignment (e.g. an h5py dataset), which is filled piece by piece and resized if necessary
+        When the interface supports read_into(), the data is received directly into the destination without intermediate copies.
+        When the interface supports read_end(), the terminator following the block is also consumed, so it isn't returned by the next read.
         
         NB: Be sure to specify include the endian specification in the format string! (e.g. ">f8" for 64-bit big-endian data)
         """
+        if format is None and out is not None:
+            format = getattr(out,'dtype','u1')
         if not self.bstream:
             # NB: When using pyvisa, multiple sequential read_raw() commands are not permitted to
             # parse *part* of a response. If the "size" argument does not match the length of the
@@ -88,67 +113,239 @@ class TelepythicDevice:
             head = data[:2]
             assert head[:1] == b'#', 'Not a binary block array'
             hlen = int(data[1:2])
-            assert hlen > 0, 'Indefinite blocks not supported'
+            if hlen == 0:
+                # indefinite block, everything up to the final NL
+                return _block_payload(data,2,len(data)-data.endswith(b'\n'),format,out)
             dlen = int(data[2:2+hlen])
             assert len(data) - (2+hlen+dlen) <= 2, 'Invalid block length'
-            data = data[2+hlen:2+hlen+dlen]
-        else:
-            # We don't know in advance how long the response is so consume piece by piece
-            head = self.read_raw(2)
-            assert head[:1] == b'#', 'Not a binary block array'
-            hlen = int(head[1:2])
-            assert hlen > 0, 'Indefinite blocks not supported'
-            dlen = self.read_raw(hlen)
-            assert len(dlen) == hlen, 'Comms fail during read_block'
-            data = self.read_raw(int(dlen))
+            return _block_payload(data,2+hlen,2+hlen+dlen,format,out)
+        # We don't know in advance how long the response is so consume piece by piece
+        dlen = self._read_block_header()
+        if dlen is None:
+            # indefinite block, receive the rest of the response into a single buffer
+            data = self._read_indefinite()
+            return _block_payload(data,0,len(data),format,out)
+        result = self._read_payload(dlen,format,out)
+        self._read_block_end()
+        return result
+    
+    def _read_payload(self,dlen,format,out):
+        """Read the "dlen" bytes of block data following the header from the bytestream, see read_block()"""
         if format is None:
-            return data
-        return np.fromstring(data,dtype=format)
+            return self.read_raw(dlen)
+        out = _block_file(out,dlen,format)
+        if out is not None and not isinstance(out,np.ndarray):
+            # write to the storage piece by piece rather than holding the whole block
+            return _block_store(self._iter_payload(dlen,format),out,dlen,format)
+        if not hasattr(self.dev,'read_into'):
+            return _block_array(self.read_raw(dlen),format,out)
+        # receive straight into the destination array
+        arr = _block_dest(dlen,format,out)
+        self.read_into(arr.view(np.uint8))
+        return _block_result(arr,out)
+    
+    def iter_block(self,format=None,chunk_bytes=1<<20,callback=None):
+        """Read a GPIB-style block (see read_block) in pieces, yielding each piece as it arrives so that memory use does not grow with the block size.
+        
+        Each piece is a 1D numpy array of dtype "format" (or a bytes string if "format" is None) of at most "chunk_bytes" bytes, rounded down to a whole number of elements.
+        If "callback" is specified, it is called as callback(received,total) after every piece. If it returns False the transfer is cancelled: the remainder of the block is discarded and iteration stops.
+        
+        NB: VISA does not support partial reads, so there the whole block is read first and then yielded in pieces. The same applies to indefinite-length blocks.
+        """
+        if not self.bstream:
+            pieces = _iter_buffer(self.read_block(),format,chunk_bytes,callback)
+        else:
+            dlen = self._read_block_header()
+            if dlen is None:
+                pieces = _iter_buffer(self._read_indefinite(),format,chunk_bytes,callback)
+            else:
+                pieces = self._iter_payload(dlen,format,chunk_bytes,callback)
+        for piece in pieces:
+            yield piece
+        if self.bstream and dlen is not None:
+            self._read_block_end()
+    
+    def _iter_payload(self,dlen,format=None,chunk_bytes=1<<20,callback=None):
+        """Generator yielding the "dlen" bytes of block data following the header in pieces, see iter_block()"""
+        step = 1 if format is None else np.dtype(format).itemsize
+        if dlen % step:
+            raise ValueError('Block length %i is not a multiple of %s'%(dlen,np.dtype(format)))
+        chunk_bytes = max(step, chunk_bytes - chunk_bytes % step)
+        direct = format is not None and hasattr(self.dev,'read_into')
+        n = 0
+        while n < dlen:
+            size = min(chunk_bytes, dlen-n)
+            if direct:
+                piece = np.empty(size//step,dtype=format)
+                self.read_into(piece.view(np.uint8))
+            else:
+                piece = self.read_raw(size)
+                if format is not None:
+                    piece = _block_array(piece,format)
+            n += size
+            yield piece
+            if callback is not None and callback(n,dlen) is False:
+                # cancelled, discard the rest of the block to keep the stream in sync
+                while n < dlen:
+                    n += len(self.read_raw(min(chunk_bytes, dlen-n)))
+                return
+    
+    def _read_block_header(self):
+        """Consume the "#NM..M" header of a GPIB block from the bytestream and return the length of the following data, or None for an indefinite-length block"""
+        if hasattr(self.dev,'skip_prompts'):
+            # e.g. a Telnet prompt still arriving from a previous command
+            self.dev.skip_prompts()
+        head = self.read_raw(2)
+        assert head[:1] == b'#', 'Not a binary block array'
+        hlen = int(head[1:2])
+        if hlen == 0:
+            return None
+        dlen = self.read_raw(hlen)
+        assert len(dlen) == hlen, 'Comms fail during read_block'
+        return int(dlen)
+    
+    def _read_block_end(self):
+        """Consume the terminator following a definite-length block on the bytestream, if the interface supports it (see TCPInterface.read_end)"""
+        if hasattr(self.dev,'read_end'):
+            self.dev.read_end()
+    
+    def _read_indefinite(self):
+        """Read the data of an indefinite-length block (following the "#0" header) from the bytestream, up to the end of the response"""
+        if not hasattr(self.dev,'read_until_end'):
+            raise TelepythicError(self.dev,None,'Indefinite blocks not supported by this interface')
+        try:
+            return self.dev.read_until_end()
+        except Exception as e:
+            raise TelepythicError(self.dev, e)
     
-    def parse_reply(self, x):
-        """Interpret the reply string and return an appropriately type-cast value"""
+    def parse_reply(self, x, query=None):
+        """
+        Interpret the reply string and return an appropriately type-cast value.
+        If the "query" it is a reply to is given, it is parsed with the reply type or Schema for its command mnemonic in "schemas" (e.g. schemas[b'TRAC:POIN?'] = int), if there is one.
+        Otherwise the type is inferred from the reply (int, float, quoted string or otherwise bytes), and cached for subsequent replies to the same command.
+        """
+        if not isinstance(x, bytes):
+            # VISA returns unicode strings
+            val = self.parse_reply(x.encode(), query)
+            return val.decode() if isinstance(val, bytes) else val
         x = x.strip()
-        # is it a string?
-        if x[0] == '"': return x[1:x.rfind('"')]
-        # is it anything at all?
-        if not len(x): return None
-        # is it an integer?
-        try:    return int(x)
-        except: pass
-        # is it a floating point value?
-        try:    return float(x)
-        except: pass
-        return x
+        if query is None:
+            return schema.convert(x, schema.infer(x))
+        key = mnemonic(query)
+        kind = self.schemas.get(key)
+        if kind is not None:
+            return kind(x)
+        return schema._infer_cached(self.inferred, key, x)
     
     def ask(self, query, size=None):
         """A helper function that writes the command "query" and reads the reply. If "size" is not None, the response is assumed to be a binary string of that length"""
         try:
-            self.dev.write(query)
-            if size is None:
-                return self.dev.read()
-            else:
-                return self.dev.read_raw(size)
+            with self.mutex, self._measure(query):
+                self.dev.write(query)
+                if size is None:
+                    return self.dev.read()
+                else:
+                    return self.dev.read_raw(size)
         except Exception as e:
             raise QueryError(self.dev, e, query)
     
-    def ask_block(self, query, format=None):
+    def ask_block(self, query, format=None, out=None):
         """A helper function to ask a query that returns a GPIB "block" format response. See also read_block()"""
         try:
-            self.dev.write(query)
-            return self.read_block(format)
+            with self.mutex, self._measure(query):
+                self.dev.write(query)
+                return self.read_block(format,out)
         except Exception as e:
             raise QueryError(self.dev, e, query)
     
-    def query(self, query):
-        """A helper function that asks "query" and returns the response. "query" can be a vector, in which case a dictionary of responses is returned."""
-        if hasattr(query,encode):   # we SHOULDN'T be passed a unicode string, but we might be
+    def ask_ascii_array(self, query, dtype='f8', count_prefix=False, sep=b',', count=None):
+        """
+        A helper function to ask a query that returns a list of numbers separated by "sep" (e.g. b'1.5,2.5,3.5'), returning a 1D numpy array of dtype "dtype".
+        If the interface supports read_chunks(), the response is parsed piece by piece as it arrives.
+        
+        Keyword arguments:
+        count_prefix -- the first number in the response is the number of values which follow, which is checked (default: False)
+        count        -- the expected number of values, if known in advance (default: None)
+        """
+        try:
+            with self.mutex, self._measure(query):
+                self.dev.write(query)
+                if hasattr(self.dev,'read_chunks'):
+                    chunks = self.dev.read_chunks()
+                else:
+                    chunks = [self.dev.read()]
+                return _ascii_array(chunks,dtype,sep,count_prefix,count)
+        except Exception as e:
+            raise QueryError(self.dev, e, query)
+    
+    def query(self, query, batch=None):
+        """
+        A helper function that asks "query" and returns the response. "query" can be a vector, in which case a dictionary of responses is returned (atomically, with respect to other threads).
+        
+        If "batch" (default: the "batch" attribute of the device) is greater than one, up to that many queries from the vector are joined with "query_sep" into a single compound message (e.g. b'A?;B?;C?') and the reply is split on "reply_sep".
+        If the device does not respond to the compound message with the expected number of replies, the remaining queries are asked one at a time and batching is not attempted again on this device.
+        """
+        if hasattr(query,'encode'):   # we SHOULDN'T be passed a unicode string, but we might be
             query = query.encode()
         if isinstance(query,bytes):
-            # ensure query string contains a query
-            if not b'?' in query: query = query + b'?'
-            return self.parse_reply(self.ask(query))
-        else:
-            return { q: self.query(q) for q in query }
+            query = _as_query(query)
+            return self.parse_reply(self.ask(query), query)
+        if batch is None:
+            batch = self.batch
+        query = list(query)
+        result = {}
+        i = 0
+        with self.mutex:
+            while batch > 1 and not self.batch_failed and i < len(query):
+                part = query[i:i+batch]
+                replies = self._ask_batch(part)
+                if replies is None:
+                    break
+                result.update(zip(part,replies))
+                i += len(part)
+            # ask anything remaining one at a time
+            for q in query[i:]:
+                result[q] = self.query(q)
+        return result
+    
+    def _ask_batch(self, queries):
+        """Ask the list of "queries" as a single compound message, returning a list of the parsed replies or None (and marking the device as not supporting batching) if that failed"""
+        msg = self.query_sep.join([_as_query(q) for q in queries])
+        try:
+            replies = self.ask(msg).split(self.reply_sep)
+        except TelepythicError:
+            replies = None
+        if replies is None or len(replies) != len(queries):
+            # the device doesn't understand compound queries, clear out whatever it sent instead
+            self.batch_failed = True
+            self.flush()
+            return None
+        return [self.parse_reply(x,_as_query(q)) for x,q in zip(replies,queries)]
+    
+    def enable_metrics(self, enable=True):
+        """
+        Start (or with enable=False, stop) recording I/O statistics for each command mnemonic sent with ask(), ask_block() or query(), and return the Metrics instance.
+        Use metrics.snapshot() to obtain the statistics and metrics.reset() to clear them.
+        Round-trip latency is always recorded; the time to first byte, bytes transferred and number of receive calls require an interface with a "stats" attribute (e.g. TCPInterface).
+        The statistics are attached to the innermost interface, beneath any wrappers such as RecordingInterface or PooledInterface, since that is where the I/O happens.
+        """
+        ifc = _innermost(self.dev)
+        if not enable:
+            self.metrics = None
+            if getattr(ifc,'stats',None) is not None:
+                ifc.stats = None
+            return None
+        if self.metrics is None:
+            self.metrics = Metrics()
+        if hasattr(ifc,'stats') and ifc.stats is None:
+            ifc.stats = IOCounters()
+        return self.metrics
+    
+    def _measure(self, query):
+        """Return a context manager which records the I/O statistics of a transaction, if enabled"""
+        if self.metrics is None:
+            return no_measurement
+        return self.metrics.measure(query, getattr(_innermost(self.dev),'stats',None))
     
     def read(self):
         """Read data from the device (until EOM)"""
@@ -164,6 +361,13 @@ class TelepythicDevice:
         except Exception as e:
             raise TelepythicError(self.dev, e)
     
+    def read_into(self, buf):
+        """Fill the writable buffer "buf" with exactly len(buf) bytes from the device, returning the number of bytes read"""
+        try:
+            return self.dev.read_into(buf)
+        except Exception as e:
+            raise TelepythicError(self.dev, e)
+    
     def write(self, msg):
         """Write the specified string to the device"""
         try:
@@ -171,6 +375,32 @@ class TelepythicDevice:
         except Exception as e:
             raise TelepythicError(self.dev, e)
     
+    def write_block(self, cmd, data, format=None):
+        """
+        Write the command "cmd" followed by the array "data" as a GPIB "block" format argument, e.g. write_block(b'TRAC:DATA',arr,'<f4') sends b'TRAC:DATA #41024...'.
+        If "format" is specified, the data is converted to that dtype (including byte order) before sending; otherwise the data is sent as stored in memory.
+        The header, data and terminator are sent without concatenation if supported by the interface (see TCPInterface.write_parts). Returns the number of bytes sent.
+        """
+        if hasattr(cmd,'encode'):
+            cmd = cmd.encode()
+        arr = np.ascontiguousarray(data, dtype=format)
+        nbytes = b'%i'%arr.nbytes
+        # separate the block from the command, unless already done
+        if len(cmd) and not cmd.endswith((b' ',b',')):
+            cmd += b' '
+        parts = [cmd + b'#%i'%len(nbytes) + nbytes, arr]
+        try:
+            with self.mutex, self._measure(cmd):
+                if hasattr(self.dev,'write_parts'):
+                    return self.dev.write_parts(parts)
+                # no scatter/gather support, have to concatenate
+                msg = parts[0] + arr.tobytes()
+                if hasattr(self.dev,'write_raw'):   # pyvisa
+                    return self.dev.write_raw(msg + (self.dev.write_termination or '').encode())
+                return self.dev.write(msg)
+        except Exception as e:
+            raise TelepythicError(self.dev, e)
+    
     def flush(self):
         """Removes any pending response, returning the number of bytes flushed, or -1 if not supported by the device"""
         if hasattr(self.dev,"flush"):
@@ -186,9 +416,194 @@ class TelepythicDevice:
             self.lock(False)
         elif hasattr(self.dev,"lock"):
             self.dev.lock(False)
+        # return pooled connections for reuse
+        if hasattr(self.dev,"release"):
+            self.dev.release()
         self.dev = None
 
 
+_mutex_lock = threading.Lock()
+def _innermost(interface):
+    """Return the interface wrapped by "interface" (e.g. a RecordingInterface or PooledInterface), following any nesting"""
+    while getattr(interface,'ifc',None) is not None:
+        interface = interface.ifc
+    return interface
+
+def _interface_mutex(interface):
+    """Return the re-entrant lock which serialises transactions on "interface", creating it if the interface doesn't have one"""
+    with _mutex_lock:
+        mutex = getattr(interface,'mutex',None)
+        if mutex is None:
+            mutex = threading.RLock()
+            try:    interface.mutex = mutex
+            except: pass
+    return mutex
+
+def _as_query(query):
+    """Ensure the command "query" is a query, encoded as a byte string"""
+    if hasattr(query,'encode'):
+        query = query.encode()
+    if not b'?' in query:
+        query = query + b'?'
+    return query
+
+def _ascii_array(chunks,dtype,sep=b',',count_prefix=False,count=None):
+    """Parse the pieces of a "sep"-separated list of numbers in "chunks" into a numpy array of dtype "dtype", see TelepythicDevice.ask_ascii_array()"""
+    arr = None if count is None else np.empty(count,dtype=dtype)
+    pieces = []     # parsed values, if the number isn't known in advance
+    n = 0           # number of values parsed
+    tail = b''      # incomplete value at the end of the previous chunk
+    for chunk in chunks:
+        if hasattr(chunk,'encode'):
+            chunk = chunk.encode()
+        data = tail + chunk
+        i = data.rfind(sep)
+        if i < 0:
+            tail = data
+            continue
+        data, tail = data[:i], data[i+len(sep):]
+        if count_prefix:
+            # the first value is the number that follow
+            first, _, data = data.partition(sep)
+            count_prefix = False
+            count = int(first)
+            if arr is None or len(arr) < count:
+                arr = np.empty(count,dtype=dtype)
+        n = _ascii_parse(data,dtype,sep,arr,pieces,n)
+    if count_prefix:
+        # the count was the only value
+        count, tail = int(tail), b''
+        arr = np.empty(count,dtype=dtype)
+    n = _ascii_parse(tail,dtype,sep,arr,pieces,n)
+    if arr is None:
+        arr = np.concatenate(pieces) if len(pieces) else np.empty(0,dtype=dtype)
+    elif n < len(arr):
+        arr = arr[:n]
+    assert count is None or n == count, 'Got %i elements, expected %i'%(n,count)
+    return arr
+
+def _ascii_parse(data,dtype,sep,arr,pieces,n):
+    """Parse the complete values in "data" into "arr" starting at index "n" (or if "arr" is None, append them to "pieces"), returning the new number of values"""
+    data = data.strip()
+    if not len(data):
+        return n
+    vals = np.fromstring(data,dtype=dtype,sep=sep.decode())
+    if len(vals) != data.count(sep) + 1:
+        raise ValueError('Malformed value in response')
+    if arr is None:
+        pieces.append(vals)
+    elif n + len(vals) > len(arr):
+        raise ValueError('Got more than %i elements'%len(arr))
+    else:
+        arr[n:n+len(vals)] = vals
+    return n + len(vals)
+
+def _block_dest(nbytes,format,out=None):
+    """Return an array of dtype "format" to receive "nbytes" of block data, either newly allocated or as a view of the "out" array"""
+    dtype = np.dtype(format)
+    if nbytes % dtype.itemsize:
+        raise ValueError('Block length %i is not a multiple of %s'%(nbytes,dtype))
+    n = nbytes // dtype.itemsize
+    if out is None:
+        return np.empty(n,dtype=dtype)
+    if not out.flags.c_contiguous or not out.flags.writeable:
+        raise ValueError('Output array must be writeable and C-contiguous')
+    if out.dtype.newbyteorder('=') != dtype.newbyteorder('='):
+        raise ValueError('Output array has incompatible dtype %s'%out.dtype)
+    if out.size < n:
+        raise ValueError('Output array too small for %i elements'%n)
+    return out.reshape(-1)[:n].view(dtype)
+
+def _block_result(arr,out=None):
+    """Convert a filled view of "out" (see _block_dest) back into the caller's byte order, in-place"""
+    if out is None or out.dtype == arr.dtype:
+        return arr
+    arr.byteswap(inplace=True)
+    return arr.view(out.dtype)
+
+def _block_file(out,nbytes,format):
+    """If "out" is a filename, create a .npy file of the right size to receive the block and return it memory-mapped"""
+    if not isinstance(out,str):
+        return out
+    dtype = np.dtype(format)
+    if nbytes % dtype.itemsize:
+        raise ValueError('Block length %i is not a multiple of %s'%(nbytes,dtype))
+    return np.lib.format.open_memmap(out,mode='w+',dtype=dtype,shape=(nbytes//dtype.itemsize,))
+
+def _block_store(pieces,out,nbytes,format):
+    """Write the arrays in "pieces" consecutively into the array-like "out" (e.g. an h5py dataset), resizing it if required"""
+    n = nbytes // np.dtype(format).itemsize
+    if len(out) < n:
+        if not hasattr(out,'resize'):
+            raise ValueError('Output too small for %i elements'%n)
+        out.resize((n,)+tuple(out.shape[1:]))
+    i = 0
+    for piece in pieces:
+        out[i:i+len(piece)] = piece
+        i += len(piece)
+    return out
+
+def _block_payload(data,start,end,format,out=None):
+    """Return the block data in data[start:end], reinterpreted as dtype "format" and/or stored in "out" as per read_block()"""
+    if format is None:
+        return bytes(data[start:end])
+    # reinterpret the payload in-place rather than slicing out a copy
+    data = memoryview(data)[start:end]
+    out = _block_file(out,len(data),format)
+    if out is not None and not isinstance(out,np.ndarray):
+        return _block_store([np.frombuffer(data,dtype=format)],out,len(data),format)
+    return _block_array(data,format,out)
+
+def _iter_buffer(data,format,chunk_bytes,callback):
+    """Generator yielding the block data already held in the buffer "data" in pieces, see TelepythicDevice.iter_block()"""
+    data = memoryview(data)
+    dlen = len(data)
+    step = 1 if format is None else np.dtype(format).itemsize
+    chunk_bytes = max(step, chunk_bytes - chunk_bytes % step)
+    for i in range(0,dlen,chunk_bytes):
+        piece = data[i:i+chunk_bytes]
+        yield bytes(piece) if format is None else _block_array(piece,format)
+        if callback is not None and callback(min(i+chunk_bytes,dlen),dlen) is False:
+            return
+
+def _block_array(data,format,out=None):
+    """Reinterpret the buffer "data" as an array of dtype "format", copying only if required to produce a writeable result"""
+    arr = np.frombuffer(data,dtype=format)
+    if out is not None:
+        dest = _block_dest(arr.nbytes,format,out)
+        dest[...] = arr
+        return _block_result(dest,out)
+    if not arr.flags.writeable:
+        arr = arr.copy()
+    return arr
+
+
+def parallel(tasks, max_workers=None):
+    """
+    Run several acquisitions concurrently, one thread per device. "tasks" is a dict mapping each device to a callable that is called with that device as its only argument, e.g.
+        results, timing = parallel({scope1: TekScope.waveform, scope2: TekScope.waveform, osa: Agilent86140b.get_trace})
+    Returns a tuple of dicts (results, timing), keyed by device, of the value returned by each callable and how long it took (in seconds).
+    Devices sharing an interface (e.g. on the same PrologixBus) are serialised by the interface lock, but otherwise the total time approaches that of the slowest device.
+    If any task raises an exception, the first one is re-raised once all tasks have finished.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    def run(dev, func):
+        start = time.time()
+        return func(dev), time.time() - start
+    results, timing = {}, {}
+    with ThreadPoolExecutor(max_workers=max_workers or max(1,len(tasks))) as pool:
+        futures = [(dev, pool.submit(run, dev, func)) for dev, func in tasks.items()]
+    error = None
+    for dev, fut in futures:
+        try:
+            results[dev], timing[dev] = fut.result()
+        except Exception as e:
+            if error is None: error = e
+    if error is not None:
+        raise error
+    return results, timing
+
+
 def find_visa(resource,timeout=1):
     """Use pyvisa to connect to a VISA resource described by "resource", which may contain wildcards.
     The VISA communications timeout is "timeout", specified in seconds."""
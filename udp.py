@@ -0,0 +1,138 @@
+"""
+TELEPYTHIC -- a python interface to test equipment
+Copyright 2014-2020 by Martijn Jasperse
+https://github.com/mjasperse/telepythic
+"""
+import socket, select, struct
+from .telepythic import ConnectionError
+from .tcp import _resolve_host
+
+class UDPInterface:
+    _protocol = 'UDP'
+    def __init__(self, host, port=23, timeout=0.25, eom=b'\n', prompt=(b':',b'?'), retries=3, tag=True, buffer=65536):
+        """
+        Create a UDP connection to the specified device, where each command is sent as a single datagram and each reply ends with a status character (e.g. ":" on success or "?" on failure, as with Galil controllers).
+        There is no connection setup or acknowledgement, so a reply is waited for only "timeout" seconds before the command is sent again, up to "retries" times.
+
+        If "tag" is True, each command starts with a 2-byte sequence number which the device echoes at the start of its reply (as Galil controllers do), so late replies (e.g. to a command which was retransmitted) are discarded rather than mistaken for the next reply.
+        Note that commands are retransmitted if the reply is lost, so a command may be executed twice.
+
+        Keyword arguments are otherwise per TelnetInterface
+        """
+        host = _resolve_host(host)
+        self.host = host
+        self.port = port
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            self.sock.connect((host, port))
+        except socket.error as e:
+            raise ConnectionError(self,e)
+        self.timeout = timeout
+        self.eom = eom
+        if isinstance(prompt,bytes):
+            prompt = [prompt]
+        self.prompt = tuple(prompt)
+        self.retries = retries
+        self.tag = tag
+        self.buffer = buffer
+        self.seq = 0
+        # the last datagram sent, to retransmit if there is no reply
+        self.last = None
+        self.replied = False
+        # received data of the current reply which has not yet been consumed
+        self.rbuf = bytearray()
+        self.stats = None
+
+    def __str__(self):
+        return '%s device at %s:%i'%(self._protocol,self.host,self.port)
+
+    def close(self):
+        """Close the associated socket"""
+        self.sock.close()
+        del self.sock
+
+    def has_reply(self,timeout=0):
+        """Checks whether a reply is waiting to be read"""
+        if len(self.rbuf):
+            return True
+        socklist = select.select([self.sock],[],[],timeout)
+        return len(socklist[0])>0
+
+    def flush(self,timeout=0):
+        """Removes any pending datagrams, and returns the number of bytes flushed"""
+        n = len(self.rbuf)
+        del self.rbuf[:]
+        while len(select.select([self.sock],[],[],timeout)[0]):
+            n += len(self.sock.recv(self.buffer))
+        return n
+
+    def write(self,msg):
+        """Sends the "msg" string as a single datagram, appending the End-Of-Message (eom) string if not present. Anything unread of the previous reply is discarded. Returns the number of bytes sent"""
+        if self.eom is not None and not msg.endswith(self.eom):
+            msg = msg + self.eom
+        if self.tag:
+            self.seq = (self.seq + 1) & 0xFFFF
+            msg = struct.pack('>H',self.seq) + msg
+        del self.rbuf[:]
+        self.last = msg
+        self.replied = False
+        return self._send(msg)
+
+    def read(self):
+        """Read the reply to the last command, up to the status character which ends it. The status character and surrounding whitespace are removed"""
+        while 1:
+            for s in self.prompt:
+                if self.rbuf.endswith(s):
+                    data = bytes(self.rbuf[:len(self.rbuf)-len(s)])
+                    del self.rbuf[:]
+                    return data.strip()
+            self._recv()
+
+    def read_raw(self,size):
+        """Reads exactly "size" bytes of the reply"""
+        data = bytearray(size)
+        self.read_into(data)
+        return bytes(data)
+
+    def read_into(self,buf):
+        """Fills the writable buffer "buf" (e.g. a bytearray or numpy array) with exactly len(buf) bytes of the reply. Returns the number of bytes read"""
+        view = memoryview(buf).cast('B')
+        size = len(view)
+        n = 0
+        while n < size:
+            if not len(self.rbuf):
+                self._recv()
+            k = min(size-n, len(self.rbuf))
+            view[n:n+k] = self.rbuf[:k]
+            del self.rbuf[:k]
+            n += k
+        return n
+
+    def _send(self,msg):
+        n = self.sock.send(msg)
+        if self.stats is not None:
+            self.stats.sent(n)
+        return n
+
+    def _recv(self):
+        """Receive the next datagram of the reply to the last command into the read buffer, retransmitting the command if the reply doesn't start in time. Returns the number of bytes received"""
+        attempts = 0
+        while 1:
+            if not len(select.select([self.sock],[],[],self.timeout)[0]):
+                # once the reply has started, the rest of it was lost
+                if self.replied or self.last is None or attempts >= self.retries:
+                    raise socket.timeout('No reply from %s'%self)
+                attempts += 1
+                self._send(self.last)
+                continue
+            data = self.sock.recv(self.buffer)
+            if self.stats is not None:
+                self.stats.received(len(data))
+            if self.tag:
+                if self.last is None or data[:2] != self.last[:2]:
+                    # a late reply to an earlier command
+                    continue
+                data = data[2:]
+            self.replied = True
+            self.rbuf += data
+            return len(data)